@@ -0,0 +1,3 @@
+"""
+WoePlanet Spelunker benchmarks
+"""
@@ -0,0 +1,165 @@
+"""
+WoePlanet Spelunker benchmarks: a synthetic, deterministic, WoePlanet corpus
+"""
+
+import math
+import random
+
+PLACETYPES = [
+    (0, 'Unknown', 'unknown'),
+    (7, 'Town', 'town'),
+    (8, 'State', 'state'),
+    (9, 'County', 'county'),
+    (10, 'LocalAdmin', 'localadmin'),
+    (11, 'Postal Code', 'zip'),
+    (12, 'Country', 'country'),
+    (14, 'Airport', 'airport'),
+    (19, 'Supername', 'region'),
+    (22, 'Suburb', 'suburb'),
+    (25, 'Zone', 'zone'),
+    (29, 'Continent', 'continent'),
+    (33, 'Estate', 'estate')
+]
+PLACETYPE_NAMES = {ptid: name for ptid, name, _shortname in PLACETYPES}
+PLACETYPE_SHORTNAMES = {ptid: shortname for ptid, _name, shortname in PLACETYPES}
+
+
+class CorpusBuilder:
+    """
+    Builds a planet of countries, each with states, counties and towns, with a hierarchy, children,
+    adjacencies, aliases and polygon geometries that look enough like the real thing
+    """
+
+    def __init__(self, **kwargs):
+        self.rng = random.Random(kwargs.get('seed', 1))
+        self.vertices = kwargs.get('vertices', 32)
+        self.docs = {}
+        self.next_woeid = 100
+
+    def add(self, placetype, name, parent, lat, lng, iso=''):
+        """
+        Add a place, as a child of `parent`
+        """
+
+        woeid = self.next_woeid
+        self.next_woeid += 1
+
+        hierarchy = {}
+        if parent:
+            hierarchy = dict(parent['woe:hierarchy'])
+            hierarchy[PLACETYPE_SHORTNAMES[parent['woe:placetype']]] = parent['woe:id']
+
+        size = 0.5 if placetype == 12 else 0.1
+        bbox = [lng - size, lat - size, lng + size, lat + size]
+        ring = []
+        for idx in range(self.vertices):
+            angle = 2 * math.pi * idx / self.vertices
+            ring.append([lng + size * math.cos(angle), lat + size * math.sin(angle)])
+        ring.append(ring[0])
+
+        doc = {
+            'woe:id': woeid,
+            'woe:name': name,
+            'woe:placetype': placetype,
+            'woe:placetype_name': PLACETYPE_NAMES[placetype],
+            'woe:hierarchy': hierarchy,
+            'woe:adjacent': [],
+            'woe:children': {},
+            'woe:lang': 'ENG',
+            'woe:repo': f'woeplanet-data-{iso.lower()}',
+            'woe:scale': placetype,
+            'woe:latitude': lat,
+            'woe:longitude': lng,
+            'woe:centroid': [lng, lat],
+            'woe:bbox': bbox,
+            'woe:alias_ENG_V': [f'{name} Alt'],
+            'woe:alias_FRE_V': [f'{name} Fr'],
+            'iso:country': iso,
+            'geom:area': size * size,
+            'geom:latitude': lat,
+            'geom:longitude': lng,
+            'geom:centroid': [lng, lat],
+            'geom:bbox': bbox,
+            'meta:indexed': '2024-01-01T00:00:00',
+            'names_all': [name],
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [ring]
+            }
+        }
+
+        self.docs[woeid] = doc
+        if parent:
+            parent['woe:children'].setdefault(PLACETYPE_SHORTNAMES[placetype], []).append(woeid)
+
+        return doc
+
+    def build(self, **kwargs):
+        """
+        Build the corpus: `countries` countries of `states` states of `counties` counties of `towns`
+        towns, plus a couple of places with no country that visit Null Island
+        """
+
+        countries = kwargs.get('countries', 20)
+        states = kwargs.get('states', 4)
+        counties = kwargs.get('counties', 3)
+        towns = kwargs.get('towns', 5)
+
+        self.next_woeid = 1
+        planet = self.add(19, 'Earth', None, 0.0, 0.0)
+        self.next_woeid = 100
+        for cidx in range(countries):
+            iso = chr(65 + cidx // 26) + chr(65 + cidx % 26)
+            lat = self.rng.uniform(-60, 60)
+            lng = self.rng.uniform(-170, 170)
+            country = self.add(12, f'Country {iso}', planet, lat, lng, iso)
+
+            previous = None
+            for sidx in range(states):
+                state = self.add(
+                    8, f'State {iso}{sidx}', country, lat + self.rng.uniform(-1, 1), lng + self.rng.uniform(-1, 1), iso
+                )
+                if previous:
+                    state['woe:adjacent'].append(previous['woe:id'])
+                    previous['woe:adjacent'].append(state['woe:id'])
+                previous = state
+
+                for kidx in range(counties):
+                    county = self.add(
+                        9,
+                        f'County {iso}{sidx}{kidx}',
+                        state,
+                        state['woe:latitude'] + self.rng.uniform(-0.1, 0.1),
+                        state['woe:longitude'] + self.rng.uniform(-0.1, 0.1),
+                        iso
+                    )
+                    for tidx in range(towns):
+                        self.add(
+                            7,
+                            f'Town {iso}{sidx}{kidx}{tidx}',
+                            county,
+                            county['woe:latitude'] + self.rng.uniform(-0.005, 0.005),
+                            county['woe:longitude'] + self.rng.uniform(-0.005, 0.005),
+                            iso
+                        )
+
+        self.add(0, 'Nowhere', planet, 0.0, 0.0, 'ZZ')
+        self.add(7, 'Null Town', planet, 0.0, 0.0, 'ZZ')
+
+        return self.docs
+
+
+def build_corpus(**kwargs):
+    """
+    Build a synthetic WoePlanet corpus, keyed by WOEID
+    """
+
+    return CorpusBuilder(**kwargs).build(**kwargs)
+
+
+def build_placetypes():
+    """
+    Build the placetypes index, keyed by placetype id
+    """
+
+    return {ptid: {'id': ptid, 'name': name, 'shortname': shortname} for ptid, name, shortname in PLACETYPES}
@@ -0,0 +1,505 @@
+# pylint: disable=broad-exception-caught,invalid-name
+"""
+WoePlanet Spelunker benchmarks: an in-memory stand-in for the Elasticsearch HTTP API
+
+Implements just enough of the Elasticsearch 7 search, multi-get, multi-search, scroll and index
+settings APIs, over documents held in memory, to serve the Spelunker without a network or a cluster
+"""
+
+import copy
+import http.server
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+
+class FakeElasticsearch:
+    """
+    In-memory Elasticsearch indices, queried with a (small) subset of the query DSL
+    """
+
+    def __init__(self, indices, **kwargs):
+        self.indices = indices
+        self.latency = kwargs.get('latency', 0.0)
+        self.calls = 0
+        self.scrolls = {}
+        self.request_cache = {}
+        self.request_cache_stats = {'hit_count': 0, 'miss_count': 0}
+        self.lock = threading.Lock()
+
+    def search(self, index, body):
+        """
+        Run a search body against an index
+        """
+
+        query = body.get('query', {})
+        hits = [doc for doc in self.indices[index].values() if matches(doc, query)]
+        if 'function_score' in query:
+            functions = query['function_score'].get('functions', [{}])
+            seed = functions[0].get('random_score', {}).get('seed', 0)
+            random.Random(seed).shuffle(hits)
+
+        sort = body.get('sort', [])
+        if sort:
+            hits.sort(key=sort_key(sort))
+
+        page = hits
+        if 'search_after' in body:
+            after = sort_key(sort)(dict(zip([next(iter(clause)) for clause in sort], body['search_after'])))
+            page = [doc for doc in hits if sort_key(sort)(doc) > after]
+
+        start = body.get('from', 0)
+        page = page[start:start + body.get('size', 10)]
+
+        rsp = {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {
+                'max_score': 1.0,
+                'hits': [self.hit(index, doc, body.get('_source', True), sort) for doc in page]
+            }
+        }
+
+        track = body.get('track_total_hits', 10000)
+        if track is not False:
+            cap = math.inf if track is True else track
+            rsp['hits']['total'] = {
+                'value': min(len(hits), cap),
+                'relation': 'gte' if len(hits) > cap else 'eq'
+            }
+
+        aggs = body.get('aggs', body.get('aggregations', {}))
+        if aggs:
+            rsp['aggregations'] = self.aggregate(hits, aggs)
+
+        return rsp
+
+    def hit(self, index, doc, source, sort):
+        """
+        Format a document as a search hit
+        """
+
+        hit = {
+            '_index': index,
+            '_id': str(doc.get('woe:id', doc.get('id'))),
+            '_score': 1.0,
+            '_source': project(doc, source)
+        }
+        if sort:
+            hit['sort'] = [doc.get(next(iter(clause))) for clause in sort]
+
+        return hit
+
+    def aggregate(self, hits, aggs):
+        """
+        Run terms, filter and top_hits aggregations over a set of hits
+        """
+
+        ret = {}
+        for name, spec in aggs.items():
+            subaggs = spec.get('aggs', spec.get('aggregations', {}))
+            if 'terms' in spec:
+                groups = {}
+                for doc in hits:
+                    value = doc.get(spec['terms']['field'])
+                    if value not in (None, ''):
+                        groups.setdefault(value, []).append(doc)
+
+                buckets = sorted(groups.items(), key=lambda kv: (-len(kv[1]), kv[0]))[:spec['terms'].get('size', 10)]
+                ret[name] = {
+                    'buckets': [dict({'key': key, 'doc_count': len(docs)}, **self.aggregate(docs, subaggs)) for key, docs in buckets]
+                }
+
+            elif 'filter' in spec:
+                docs = [doc for doc in hits if matches(doc, spec['filter'])]
+                ret[name] = dict({'doc_count': len(docs)}, **self.aggregate(docs, subaggs))
+
+            elif 'top_hits' in spec:
+                top_hits = spec['top_hits']
+                docs = sorted(hits, key=sort_key(top_hits['sort'])) if 'sort' in top_hits else hits
+                ret[name] = {
+                    'hits': {
+                        'total': {'value': len(hits), 'relation': 'eq'},
+                        'hits': [self.hit('', doc, top_hits.get('_source', True), []) for doc in docs[:top_hits.get('size', 3)]]
+                    }
+                }
+
+            else:
+                raise ValueError(f'Unsupported aggregation {spec}')
+
+        return ret
+
+    def mget(self, index, body, params):
+        """
+        Get documents by id
+        """
+
+        source = body.get('_source', True)
+        if '_source_includes' in params or '_source_excludes' in params:
+            source = {
+                'includes': [field for field in params.get('_source_includes', '').split(',') if field],
+                'excludes': [field for field in params.get('_source_excludes', '').split(',') if field]
+            }
+
+        docs = []
+        for _id in body.get('ids', None) or [doc['_id'] for doc in body['docs']]:
+            doc = self.indices[index].get(int(_id), None)
+            if doc is None:
+                docs.append({'_index': index, '_id': str(_id), 'found': False})
+            else:
+                docs.append({'_index': index, '_id': str(_id), 'found': True, '_source': project(doc, source)})
+
+        return {'docs': docs}
+
+    def cached_search(self, index, body, request_cache=None):
+        """
+        Run a search through the shard request cache: like Elasticsearch, `size: 0` searches are
+        cached unless `request_cache` is false, and a true `request_cache` caches any search
+        """
+
+        if request_cache is None:
+            request_cache = body.get('size', 10) == 0
+        if not request_cache:
+            return self.search(index, body)
+
+        key = (index, json.dumps(body, sort_keys=True))
+        with self.lock:
+            rsp = self.request_cache.get(key, None)
+            self.request_cache_stats['hit_count' if rsp else 'miss_count'] += 1
+
+        if rsp is None:
+            rsp = self.search(index, body)
+            with self.lock:
+                self.request_cache[key] = rsp
+
+        return copy.deepcopy(rsp)
+
+    def msearch(self, index, lines):
+        """
+        Run a batch of searches
+        """
+
+        responses = []
+        for header, body in zip(lines[0::2], lines[1::2]):
+            try:
+                rsp = self.cached_search(header.get('index', index), body, flag(header.get('request_cache', None)))
+                responses.append(dict(rsp, status=200))
+            except Exception as exc:
+                responses.append({'error': {'type': 'fake_error', 'reason': str(exc)}, 'status': 400})
+
+        return {'took': 1, 'responses': responses}
+
+    def scroll_start(self, index, body, size):
+        """
+        Start a scroll, returning the first page
+        """
+
+        body = dict(body, size=10 ** 9)
+        body.pop('sort', None)
+        rsp = self.search(index, body)
+        hits = rsp['hits']['hits']
+
+        with self.lock:
+            scroll_id = f'scroll{len(self.scrolls)}'
+            self.scrolls[scroll_id] = {'hits': hits[size:], 'size': size, 'total': len(hits)}
+
+        rsp['hits']['hits'] = hits[:size]
+        rsp['_scroll_id'] = scroll_id
+        return rsp
+
+    def scroll_next(self, scroll_id):
+        """
+        Get the next page of a scroll
+        """
+
+        state = self.scrolls[scroll_id]
+        page, state['hits'] = state['hits'][:state['size']], state['hits'][state['size']:]
+
+        return {
+            '_scroll_id': scroll_id,
+            'took': 1,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {
+                'total': {'value': state['total'], 'relation': 'eq'},
+                'hits': page
+            }
+        }
+
+    def handle(self, method, path, params, raw):
+        """
+        Route an HTTP request to an API, returning a status and a response body
+        """
+
+        parts = [part for part in path.split('/') if part]
+        with self.lock:
+            self.calls += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if not parts:
+            return 200, {'version': {'number': '7.17.9', 'build_flavor': 'default'}, 'tagline': 'You Know, for Search'}
+
+        if parts[:2] == ['_cluster', 'health']:
+            names = parts[2].split(',') if len(parts) > 2 else []
+            status = 'green' if all(name in self.indices for name in names) else 'red'
+            return 200, {'cluster_name': 'bench', 'status': status, 'timed_out': False}
+
+        if parts[-1] == '_msearch':
+            lines = [json.loads(line) for line in raw.decode('utf-8').splitlines() if line.strip()]
+            return 200, self.msearch(parts[0] if len(parts) > 1 else None, lines)
+
+        body = json.loads(raw) if raw else {}
+        if parts[-2:] == ['_search', 'scroll']:
+            if method == 'DELETE':
+                return 200, {'succeeded': True, 'num_freed': 1}
+            return 200, self.scroll_next(body.get('scroll_id', params.get('scroll_id')))
+
+        if parts[-1] == '_search' and 'scroll' in params:
+            return 200, self.scroll_start(parts[0], body, int(params.get('size', body.get('size', 10))))
+
+        if parts[-1] == '_search':
+            return 200, self.cached_search(parts[0], body, flag(params.get('request_cache', None)))
+
+        if parts[-2:] == ['_stats', 'request_cache']:
+            with self.lock:
+                stats = dict(self.request_cache_stats, memory_size_in_bytes=0, evictions=0)
+            return 200, {'_all': {'primaries': {'request_cache': stats}, 'total': {'request_cache': stats}}}
+
+        if parts[-1] == '_mget':
+            return 200, self.mget(parts[0], body, params)
+
+        if '_settings' in parts:
+            return 200, {f'{parts[0]}-v1': {'settings': {'index': {'uuid': f'bench-{parts[0]}'}}}}
+
+        if parts[-1] == '_count':
+            return 200, {'count': len(self.indices[parts[0]])}
+
+        return 404, {'error': {'root_cause': [{'type': 'index_not_found_exception'}]}, 'status': 404}
+
+
+class FakeElasticsearchHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP front end to a FakeElasticsearch
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    fake = None
+
+    def log_message(self, *args):    # pylint: disable=arguments-differ
+        pass
+
+    def reply(self, status, payload):
+        """
+        Send a JSON response
+        """
+
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('x-elastic-product', 'Elasticsearch')
+        self.send_header('content-length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        """
+        Handle a HEAD request
+        """
+
+        self.send_response(200)
+        self.send_header('x-elastic-product', 'Elasticsearch')
+        self.send_header('content-length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        """
+        Handle a GET, POST or DELETE request
+        """
+
+        length = int(self.headers.get('content-length', 0) or 0)
+        raw = self.rfile.read(length) if length else b''
+        path, _, query = self.path.partition('?')
+        params = dict(urllib.parse.parse_qsl(query))
+
+        try:
+            status, payload = self.fake.handle(self.command, path, params, raw)
+
+        except Exception as exc:
+            logger.exception('Fake Elasticsearch error for %s %s', self.command, self.path)
+            status, payload = 400, {'error': {'root_cause': [{'type': 'fake_error', 'reason': str(exc)}], 'reason': str(exc)}, 'status': 400}
+
+        self.reply(status, payload)
+
+    do_GET = do_POST
+    do_DELETE = do_POST
+
+
+def matches(doc, query):
+    """
+    Check whether a document matches a query
+    """
+
+    if not query:
+        return True
+
+    (kind, spec), = query.items()
+    if kind == 'match_all':
+        return True
+
+    if kind == 'bool':
+        for clause in spec.get('must', []) + spec.get('filter', []):
+            if not matches(doc, clause):
+                return False
+        for clause in spec.get('must_not', []):
+            if matches(doc, clause):
+                return False
+        should = spec.get('should', [])
+        return not should or any(matches(doc, clause) for clause in should)
+
+    if kind == 'function_score':
+        return matches(doc, spec.get('query', {}))
+
+    if kind == 'constant_score':
+        return matches(doc, spec['filter'])
+
+    if kind == 'ids':
+        return doc.get('woe:id', doc.get('id')) in {int(value) for value in spec['values']}
+
+    if kind == 'exists':
+        return doc.get(spec['field']) is not None
+
+    if kind == 'term':
+        (field, value), = spec.items()
+        value = value['value'] if isinstance(value, dict) else value
+        got = doc.get(field)
+        return got == value or (isinstance(got, list) and value in got)
+
+    if kind == 'terms':
+        (field, values), = spec.items()
+        return doc.get(field) in values
+
+    if kind == 'match':
+        (field, value), = spec.items()
+        value = value['query'] if isinstance(value, dict) else value
+        got = doc.get(field)
+        if got is None:
+            return False
+        words = set(str(value).lower().split())
+        return any(words & set(str(item).lower().split()) for item in (got if isinstance(got, list) else [got]))
+
+    if kind == 'geo_shape':
+        shape = spec['geometry']['shape']
+        lng, lat = shape['coordinates']
+        return distance(lng, lat, doc['woe:longitude'], doc['woe:latitude']) <= to_metres(shape['radius'])
+
+    raise ValueError(f'Unsupported query {kind}')
+
+
+def flag(value):
+    """
+    Parse a boolean query string parameter, or None if it isn't set
+    """
+
+    if value is None:
+        return None
+
+    return str(value).lower() == 'true'
+
+
+def project(doc, source):
+    """
+    Filter a document's fields with a _source specification
+    """
+
+    if source is True or source is None:
+        return dict(doc)
+    if source is False:
+        return None
+
+    if isinstance(source, (list, str)):
+        source = {'includes': source if isinstance(source, list) else [source]}
+
+    includes = [re.compile(pattern.replace('*', '.*')) for pattern in source.get('includes', [])]
+    excludes = [re.compile(pattern.replace('*', '.*')) for pattern in source.get('excludes', [])]
+
+    ret = {}
+    for key, value in doc.items():
+        if includes and not any(pattern.fullmatch(key) for pattern in includes):
+            continue
+        if any(pattern.fullmatch(key) for pattern in excludes):
+            continue
+        ret[key] = value
+
+    return ret
+
+
+def sort_key(sort):
+    """
+    Build a sort key function from a sort specification; missing values sort last
+    """
+
+    def key(doc):
+        values = []
+        for clause in sort:
+            (field, opts), = clause.items()
+            value = doc.get(field)
+            value = math.inf if value is None else value
+            if isinstance(opts, dict) and opts.get('order', 'asc') == 'desc' or opts == 'desc':
+                value = -value
+            values.append(value)
+
+        return values
+
+    return key
+
+
+def distance(lng1, lat1, lng2, lat2):
+    """
+    Great circle distance between two points, in metres
+    """
+
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    hav = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+
+    return 2 * 6371000 * math.asin(math.sqrt(hav))
+
+
+def to_metres(value):
+    """
+    Convert an Elasticsearch distance (a number of metres, or a string such as 1km) to metres
+    """
+
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    match = re.match(r'^([\d.]+)\s*(km|m)?$', str(value))
+    return float(match.group(1)) * (1000 if match.group(2) == 'km' else 1)
+
+
+def serve(indices, **kwargs):
+    """
+    Serve a FakeElasticsearch over HTTP on a background thread, returning it and its server
+    """
+
+    fake = FakeElasticsearch(indices, **kwargs)
+    handler = type('Handler', (FakeElasticsearchHandler,), {'fake': fake})
+    server = http.server.ThreadingHTTPServer((kwargs.get('host', '127.0.0.1'), kwargs.get('port', 0)), handler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, name='fake-elasticsearch', daemon=True)
+    thread.start()
+
+    return fake, server
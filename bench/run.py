@@ -0,0 +1,363 @@
+# pylint: disable=import-outside-toplevel
+"""
+WoePlanet Spelunker benchmarks: drive the hot routes against an in-memory Elasticsearch and report
+throughput, latency percentiles and backend calls per request
+
+    python -m bench.run [--requests 200] [--concurrency 1] [--cache] [--latency 0] [--routes place,search]
+
+Results are saved to bench/results/, named for the commit they were run against, and compared with
+the previous run so regressions show up between commits.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import pathlib
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from bench.corpus import build_corpus, build_placetypes
+from bench.fakees import serve
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / 'bench' / 'results'
+ROUTES = ('place', 'search', 'nearby', 'countries', 'placetypes', 'placetype')
+PLACETYPE_NAMES = ('town', 'county', 'state', 'country')
+
+
+class Routes:
+    """
+    Generates request URLs for each benchmarked route, from the corpus
+    """
+
+    def __init__(self, docs, seed=1):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.places = [doc for woeid, doc in sorted(docs.items()) if woeid != 1]
+        self.towns = [doc for doc in self.places if doc['woe:placetype'] == 7 and doc['iso:country'] != 'ZZ']
+
+    def url(self, route):
+        """
+        Get a URL for a route
+        """
+
+        with self.lock:
+            if route == 'place':
+                return f"/id/{self.rng.choice(self.places)['woe:id']}/"
+
+            if route == 'search':
+                return f"/search/?{urllib.parse.urlencode({'q': self.rng.choice(self.places)['woe:name']})}"
+
+            if route == 'nearby':
+                town = self.rng.choice(self.towns)
+                return f"/nearby/?lat={town['woe:latitude']}&lng={town['woe:longitude']}&radius=5000"
+
+            if route == 'countries':
+                return '/countries/'
+
+            if route == 'placetypes':
+                return '/placetypes/'
+
+            if route == 'placetype':
+                return f'/placetype/{self.rng.choice(PLACETYPE_NAMES)}/?page={self.rng.randint(1, 2)}'
+
+        raise ValueError(f'Unknown route {route}')
+
+
+def parse_args():
+    """
+    Parse the command line
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the Spelunker against an in-memory Elasticsearch')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma separated routes to drive')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per route')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrent clients')
+    parser.add_argument('--latency', type=float, default=0.0, help='backend latency per request, in ms')
+    parser.add_argument('--cache', action='store_true', help='leave the page and place caches on')
+    parser.add_argument('--countries', type=int, default=20, help='countries in the synthetic corpus')
+    parser.add_argument('--towns', type=int, default=5, help='towns per county in the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the corpus and the URLs')
+    parser.add_argument('--compare', default=None, help='results file to compare with (default: the previous run)')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percentage change flagged as a regression')
+    parser.add_argument('--no-save', action='store_true', help="don't save the results")
+
+    return parser.parse_args()
+
+
+def load_app(args, port, cache_dir):
+    """
+    Configure the environment for, and import, the Spelunker Flask application
+    """
+
+    os.environ.update({
+        'WOE_ES_HOST': '127.0.0.1',
+        'WOE_ES_PORT': str(port),
+        'WOE_ES_DOC_INDEX': 'woeplanet',
+        'WOE_ES_PT_INDEX': 'placetypes',
+        'WOE_CACHE_DIR': cache_dir,
+        'WOE_CACHE_MASK': '0o755',
+        'WOE_REQUEST_LOG': 'false'
+    })
+    if not args.cache:
+        os.environ.update({
+            'WOE_CACHE_BACKEND': 'null',
+            'WOE_CACHE_LOCAL_SIZE': '0'
+        })
+
+    os.chdir(ROOT)
+    from spelunker import spelunker
+
+    return spelunker.app
+
+
+def backend_stats(response):
+    """
+    Get the backend calls and bytes for a response, from its Server-Timing header
+    """
+
+    timing = response.headers.get('Server-Timing', '')
+    match = re.search(r'(\d+) calls, (\d+) bytes', timing)
+    if not match:
+        return 0, 0
+
+    return int(match.group(1)), int(match.group(2))
+
+
+def request_cache_stats(port, index):
+    """
+    Get the shard request cache hit and miss counts for an index
+    """
+
+    url = f'http://127.0.0.1:{port}/{index}/_stats/request_cache'
+    with urllib.request.urlopen(url, timeout=10) as rsp:
+        stats = json.loads(rsp.read())['_all']['total']['request_cache']
+
+    return stats['hit_count'], stats['miss_count']
+
+
+def drive(app, routes, route, count, concurrency):
+    """
+    Make `count` requests to a route from `concurrency` clients, returning per-request samples and the
+    elapsed time
+    """
+
+    local = threading.local()
+
+    def request(_idx):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+
+        url = routes.url(route)
+        started = time.perf_counter()
+        response = client.get(url)
+        size = len(response.get_data())
+        elapsed = time.perf_counter() - started
+        calls, nbytes = backend_stats(response)
+
+        return {
+            'url': url,
+            'status': response.status_code,
+            'seconds': elapsed,
+            'calls': calls,
+            'es_bytes': nbytes,
+            'bytes': size
+        }
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(request, range(count)))
+    else:
+        samples = [request(idx) for idx in range(count)]
+
+    return samples, time.perf_counter() - started
+
+
+def summarise(samples, elapsed, cache_hits, cache_misses):
+    """
+    Summarise a route's samples, and its shard request cache hits and misses
+    """
+
+    latencies = sorted(sample['seconds'] * 1000 for sample in samples)
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample['status'] >= 500),
+        'rps': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentiles[49], 2),
+        'p95_ms': round(percentiles[94], 2),
+        'p99_ms': round(percentiles[98], 2),
+        'calls_per_request': round(statistics.mean(sample['calls'] for sample in samples), 2),
+        'es_bytes_per_request': round(statistics.mean(sample['es_bytes'] for sample in samples)),
+        'bytes_per_request': round(statistics.mean(sample['bytes'] for sample in samples)),
+        'request_cache_lookups': cache_hits + cache_misses,
+        'request_cache_hit_rate': round(cache_hits / (cache_hits + cache_misses), 3) if cache_hits + cache_misses else None
+    }
+
+
+def git_commit():
+    """
+    Get the current commit, and whether the working tree has uncommitted changes
+    """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        return commit, bool(dirty)
+
+    except (OSError, subprocess.CalledProcessError) as _exc:    # noqa: F841
+        return 'unknown', False
+
+
+def settings(args):
+    """
+    Get the run settings that affect the results, so only like runs are compared
+    """
+
+    return {key: args[key] for key in ('concurrency', 'latency', 'cache', 'countries', 'towns', 'seed')}
+
+
+def previous_results(args):
+    """
+    Get the most recently saved results file for a run with the same settings
+    """
+
+    for path in sorted(RESULTS_DIR.glob('*.json'), reverse=True):
+        previous = json.loads(path.read_text(encoding='utf-8'))
+        if settings(previous['args']) == settings(args):
+            return path
+
+    return None
+
+
+def compare(current, previous, threshold):
+    """
+    Print the change in throughput, tail latency and backend calls between two runs, flagging
+    regressions
+    """
+
+    print(f"\nCompared with {previous['commit']}{' (dirty)' if previous.get('dirty') else ''} at {previous['timestamp']}")
+    regressions = 0
+    for route, result in current['results'].items():
+        before = previous['results'].get(route, None)
+        if not before:
+            continue
+
+        flags = []
+        if before['rps'] and result['rps'] < before['rps'] * (1 - threshold / 100):
+            flags.append('throughput')
+        if before['p95_ms'] and result['p95_ms'] > before['p95_ms'] * (1 + threshold / 100):
+            flags.append('p95')
+        if result['calls_per_request'] > before['calls_per_request']:
+            flags.append('backend calls')
+        regressions += len(flags)
+
+        print(
+            f"{route:<10} rps {change(before['rps'], result['rps']):>8}  p95 {change(before['p95_ms'], result['p95_ms']):>8}"
+            f"  calls {before['calls_per_request']:g} -> {result['calls_per_request']:g}"
+            f"{'  REGRESSION: ' + ', '.join(flags) if flags else ''}"
+        )
+
+    return regressions
+
+
+def change(before, after):
+    """
+    Format the relative change between two values
+    """
+
+    if not before:
+        return 'n/a'
+
+    return f'{(after - before) / before * 100:+.1f}%'
+
+
+def main():
+    """
+    Run the benchmarks
+    """
+
+    args = parse_args()
+    routes = [route.strip() for route in args.routes.split(',') if route.strip()]
+    for route in routes:
+        if route not in ROUTES:
+            sys.exit(f"Unknown route {route}; choose from {', '.join(ROUTES)}")
+
+    docs = build_corpus(countries=args.countries, towns=args.towns, seed=args.seed)
+    indices = {
+        'woeplanet': docs,
+        'placetypes': build_placetypes()
+    }
+    fake, server = serve(indices)
+
+    with tempfile.TemporaryDirectory(prefix='spelunker-bench-') as cache_dir:
+        port = server.server_address[1]
+        app = load_app(args, port, cache_dir)
+        generator = Routes(docs, seed=args.seed)
+
+        results = {}
+        for route in routes:
+            drive(app, generator, route, args.warmup, args.concurrency)
+            hits, misses = request_cache_stats(port, 'woeplanet')
+            fake.latency = args.latency / 1000
+            samples, elapsed = drive(app, generator, route, args.requests, args.concurrency)
+            fake.latency = 0.0
+            after_hits, after_misses = request_cache_stats(port, 'woeplanet')
+            results[route] = summarise(samples, elapsed, after_hits - hits, after_misses - misses)
+
+    server.shutdown()
+
+    commit, dirty = git_commit()
+    current = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': len(docs),
+        'args': vars(args),
+        'results': results
+    }
+
+    print(
+        f"{'route':<10} {'reqs':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'calls':>6} {'ES bytes':>9}"
+        f" {'bytes':>8} {'RC hits':>8}"
+    )
+    for route, result in results.items():
+        hit_rate = result['request_cache_hit_rate']
+        print(
+            f"{route:<10} {result['requests']:>6} {result['errors']:>6} {result['rps']:>8} {result['p50_ms']:>8} {result['p95_ms']:>8}"
+            f" {result['p99_ms']:>8} {result['calls_per_request']:>6} {result['es_bytes_per_request']:>9} {result['bytes_per_request']:>8}"
+            f" {'-' if hit_rate is None else f'{hit_rate:.0%}':>8}"
+        )
+    print('\nRC hits: the shard request cache hit rate for the backend searches each route made')
+
+    previous = pathlib.Path(args.compare) if args.compare else previous_results(vars(args))
+    if previous and previous.exists():
+        compare(current, json.loads(previous.read_text(encoding='utf-8')), args.threshold)
+
+    if not args.no_save:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        path = RESULTS_DIR / f"{stamp}-{commit}{'-dirty' if dirty else ''}.json"
+        path.write_text(json.dumps(current, indent=2) + '\n', encoding='utf-8')
+        print(f'\nSaved results to {path.relative_to(ROOT)}')
+
+
+if __name__ == '__main__':
+    main()
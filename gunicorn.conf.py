@@ -4,6 +4,8 @@ WoePlanet Spelunker Docker gunicorn configuration settings
 """
 
 import multiprocessing
+import os
+
 import setproctitle    # pylint: disable=unused-import # noqa: F401
 
 # Server Mechanics: https://docs.gunicorn.org/en/latest/settings.html#server-mechanics
@@ -17,7 +19,13 @@ forwarded_allow_ips = '*'
 # workers = multiprocessing.cpu_count() * 2 + 1
 workers = 2
 max_requests = 1000
-# worker_class = 'uvicorn.workers.UvicornWorker'
+
+# WOE_WORKER_MODE=async serves the ASGI application from asyncio workers, with async backend requests
+if os.environ.get('WOE_WORKER_MODE', 'sync').lower() == 'async':
+    wsgi_app = 'spelunker.asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'spelunker.spelunker:app'
 
 # Logging: https://docs.gunicorn.org/en/stable/settings.html#logging
 # Disable accesslog; route logging is handled by RouteLoggerMiddleware in the application itself
@@ -27,3 +35,57 @@ loglevel = 'info'
 
 # Process naming: https://docs.gunicorn.org/en/stable/settings.html#process-naming
 proc_name = 'woeplanet-spelunker'
+
+
+# Server Hooks: https://docs.gunicorn.org/en/stable/settings.html#server-hooks
+def on_starting(_server):
+    """
+    Clear out the metrics workers left behind in a previous run
+    """
+
+    from spelunker import metrics    # pylint: disable=import-outside-toplevel
+
+    metrics.reset(metrics.metrics_dir())
+
+
+def post_worker_init(_worker):
+    """
+    Warm per-worker state once the application has been loaded
+    """
+
+    from spelunker import inflection    # pylint: disable=import-outside-toplevel
+    from spelunker.placetypes import placetype_registry    # pylint: disable=import-outside-toplevel
+    from spelunker.snapshot import get_snapshot    # pylint: disable=import-outside-toplevel
+
+    registry = placetype_registry()
+    snapshot = get_snapshot()
+    if snapshot and snapshot.registry:
+        registry.preload(snapshot.registry, snapshot.path)
+    else:
+        registry.load()
+
+    words = set()
+    for placetype in registry.ids.values():
+        name = placetype.get('name', None) or ''
+        words.update((name, name.lower(), placetype['shortname']))
+    inflection.warm(words)
+
+
+def worker_exit(_server, _worker):
+    """
+    Write the exiting worker's final metrics, for the arbiter to archive
+    """
+
+    from spelunker import metrics    # pylint: disable=import-outside-toplevel
+
+    metrics.metrics().flush()
+
+
+def child_exit(_server, worker):
+    """
+    Fold an exited worker's metrics into the archive, so recycling workers doesn't reset counters
+    """
+
+    from spelunker import metrics    # pylint: disable=import-outside-toplevel
+
+    metrics.archive(metrics.metrics_dir(), worker.pid)
@@ -0,0 +1,251 @@
+# pylint: disable=broad-exception-caught
+"""
+WoePlanet Spelunker ASGI application, for the async serving mode
+
+Routes with an async handler are served on the event loop, with an AsyncElasticsearch backed
+QueryManager; every other route (and anything the bot blocker turns away) is handed to the Flask
+WSGI application on a bounded thread pool. Routing, request setup, error handling and responses all
+go through the Flask application, so both modes serve identical routes.
+"""
+
+# gunicorn spelunker.asgi:app -k uvicorn.workers.UvicornWorker --bind $(hostname):8888 -w 2
+
+import asyncio
+import inspect
+import io
+import os
+
+import a2wsgi
+import flask
+import werkzeug.exceptions
+from a2wsgi.wsgi import build_environ
+
+from spelunker import esclient, spelunker
+from spelunker.placetypes import placetype_registry
+from spelunker.querymanager import AsyncQueryManager
+
+
+class SpelunkerASGI:
+    """
+    ASGI front end to the Spelunker Flask application, serving async routes on the event loop
+    """
+
+    def __init__(self, flask_app, views, **kwargs):
+        self.flask_app = flask_app
+        self.views = views
+        self.wsgi = a2wsgi.WSGIMiddleware(flask_app, workers=kwargs.get('workers', 10))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        view = None
+        if scope['type'] == 'http':
+            environ = build_environ(scope, io.BytesIO())
+            view, view_args = self.match(environ)
+
+        if view is None:
+            await self.wsgi(scope, receive, send)
+            return
+
+        with self.flask_app.request_context(environ):
+            rsp = await self.dispatch(view, view_args)
+            try:
+                await self.respond(rsp, scope, send)
+            finally:
+                rsp.close()
+
+    async def lifespan(self, receive, send):
+        """
+        Handle the ASGI lifespan protocol, closing the async Elasticsearch client on shutdown
+        """
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                await esclient.close_async_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def match(self, environ):
+        """
+        Match a request to an async view, or None if it should be handed to the WSGI application
+        """
+
+        user_agent = environ.get('HTTP_USER_AGENT', '').lower()
+        if any(agent in user_agent for agent in spelunker.AGENTS):
+            return None, None
+
+        try:
+            endpoint, view_args = self.flask_app.url_map.bind_to_environ(environ).match()
+
+        except werkzeug.exceptions.HTTPException as _exc:    # noqa: F841
+            return None, None
+
+        return self.views.get(endpoint, None), view_args
+
+    async def dispatch(self, view, view_args):
+        """
+        Run the request hooks and an async view, turning the result into a Flask response
+        """
+
+        try:
+            rv = self.flask_app.preprocess_request()
+            if rv is None:
+                # Views look placetypes up synchronously; a registry that's only stale is refreshed
+                # in the background, but an empty one is loaded in place, so do that off the loop
+                registry = placetype_registry()
+                if not registry.ids:
+                    await asyncio.to_thread(registry.ensure)
+
+                flask.g.docmgr = AsyncQueryManager(index=flask.g.docidx)
+                flask.g.ptmgr = AsyncQueryManager(index=flask.g.ptidx)
+                rv = view(**view_args)
+                if inspect.isawaitable(rv):
+                    rv = await rv
+
+            return self.flask_app.finalize_request(rv)
+
+        except Exception as exc:
+            return await asyncio.to_thread(self.handle_error, exc)
+
+    def handle_error(self, exc):
+        """
+        Handle an exception from an async view with the Flask application's error handlers
+
+        Error handlers render pages and may block, so this is run off the event loop
+        """
+
+        try:
+            try:
+                raise exc
+
+            except Exception as raised:
+                return self.flask_app.finalize_request(self.flask_app.handle_user_exception(raised))
+
+        except Exception as uncaught:
+            return self.flask_app.handle_exception(uncaught)
+
+    async def respond(self, rsp, scope, send):
+        """
+        Send a Flask response, streaming its body from either a sync or an async iterable
+        """
+
+        await send({
+            'type': 'http.response.start',
+            'status': rsp.status_code,
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in rsp.headers.items()]
+        })
+
+        if scope['method'] != 'HEAD':
+            if inspect.isasyncgen(rsp.response):
+                async for chunk in rsp.response:
+                    chunk = chunk.encode(rsp.charset) if isinstance(chunk, str) else chunk
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+            else:
+                for chunk in rsp.iter_encoded():
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def find_by_id(woeid, **kwargs):
+    """
+    Get a document by WOEID, and whether the backend answered
+    """
+
+    rsp = await flask.g.docmgr.query(body=spelunker.ids_query([woeid], **kwargs))
+
+    if 'hits' in rsp:
+        return flask.g.docmgr.single(rsp), True
+
+    if 'error' in rsp:
+        flask.current_app.logger.error(rsp['error'])
+
+    else:
+        flask.current_app.logger.error(rsp)
+
+    return None, False
+
+
+async def api_place(woeid):
+    """
+    API handler: place by WOEID, as a GeoJSON FeatureCollection
+    """
+
+    try:
+        terse, source, _limit = spelunker.get_api_params()
+    except ValueError as exc:
+        return spelunker.api_error(400, str(exc))
+
+    args = {}
+    if source:
+        args['includes'] = source
+
+    doc, ok = await find_by_id(woeid, **args)
+    if not ok:
+        return spelunker.api_error(503, f'Unable to get WOEID {woeid}')
+    if not doc:
+        return spelunker.api_error(404, f'WOEID {woeid} not found')
+
+    return flask.Response(
+        spelunker.stream_geojson([doc], terse=terse),
+        mimetype='application/geo+json'
+    )
+
+
+async def api_nearby():
+    """
+    API handler: places near a coordinate or a WOEID, as a streamed GeoJSON FeatureCollection
+    """
+
+    try:
+        lat = spelunker.get_api_number('lat', spelunker.sanitize_float)
+        lng = spelunker.get_api_number('lng', spelunker.sanitize_float)
+        woeid = spelunker.get_api_number('woeid', spelunker.sanitize_int)
+        radius = spelunker.get_api_number('radius', spelunker.sanitize_float)
+    except ValueError as exc:
+        return spelunker.api_error(400, str(exc))
+
+    if woeid:
+        args = {
+            'includes': spelunker.CENTROID_INCLUDES
+        }
+        doc, ok = await find_by_id(woeid, **args)
+        if not ok:
+            return spelunker.api_error(503, f'Unable to get WOEID {woeid}')
+        if not doc:
+            return spelunker.api_error(404, f'WOEID {woeid} not found')
+
+        coords = doc.get('woe:centroid', doc.get('geom:centroid', [0, 0]))
+
+    elif lat is not None and lng is not None:
+        coords = [lng, lat]
+
+    else:
+        return spelunker.api_error(400, 'Missing lat and lng, or woeid, parameters')
+
+    return spelunker.api_scan(spelunker.api_nearby_params(coords, radius))
+
+
+# Views served on the event loop, by Flask endpoint. The API search and placetype views don't touch
+# the backend until they're streamed, so with an async QueryManager they're served as they are; the
+# placetype registry they consult is loaded off the loop by dispatch().
+ASYNC_VIEWS = {
+    'health_check': spelunker.health_check,
+    'api_place': api_place,
+    'api_search': spelunker.api_search,
+    'api_nearby': api_nearby,
+    'api_placetype': spelunker.api_placetype
+}
+
+app = SpelunkerASGI(
+    spelunker.app,
+    ASYNC_VIEWS,
+    workers=int(os.environ.get('WOE_WSGI_THREADS', '10'))
+)
@@ -0,0 +1,209 @@
+# pylint: disable=broad-exception-caught
+"""
+WoePlanet two tier page cache: an in-process LRU in front of a shared cache backend
+"""
+
+import collections
+import math
+import os
+import threading
+import time
+
+from flask_caching.backends.base import BaseCache
+from flask_caching.backends.filesystemcache import FileSystemCache
+from flask_caching.backends.memcache import MemcachedCache
+from flask_caching.backends.nullcache import NullCache
+from flask_caching.backends.rediscache import RedisCache
+
+from spelunker import metrics
+
+
+class LayeredCache(BaseCache):
+    """
+    A bounded, per-process, LRU cache in front of a shared (filesystem, Redis or memcached) cache
+
+    Entries stay in the shared cache for `stale_timeout` seconds after they expire. The first caller
+    to see an expired (or missing) entry takes a per-key rebuild lock in the shared cache and gets a
+    miss; everyone else is served the stale entry (or, for a missing entry, waits up to `wait`
+    seconds for the rebuilt one) until the rebuild is written back. A rebuild that fails, such as a
+    view that aborts, never writes back, so its lock must be let go with `release_rebuilds()` at the
+    end of the request.
+    """
+
+    def __init__(self, shared, **kwargs):
+        super().__init__(default_timeout=kwargs.get('default_timeout', 300))
+        self.shared = shared
+        self.local_size = kwargs.get('local_size', 256)
+        self.local_timeout = kwargs.get('local_timeout', 5)
+        self.stale_timeout = kwargs.get('stale_timeout', 30)
+        self.lock_timeout = kwargs.get('lock_timeout', 10)
+        self.wait = kwargs.get('wait', 2.0)
+        self.local = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.held = threading.local()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        backend = config.get('CACHE_SHARED_TYPE', 'filesystem')
+        timeout = kwargs.get('default_timeout', 300)
+
+        if backend == 'redis':
+            shared = RedisCache.factory(app, config, [], {'default_timeout': timeout})
+        elif backend == 'memcached':
+            shared = MemcachedCache.factory(app, config, [], {'default_timeout': timeout})
+        elif backend == 'null':
+            shared = NullCache(default_timeout=timeout)
+        else:
+            shared = FileSystemCache.factory(app, config, list(args), dict(kwargs))
+
+        return cls(
+            shared,
+            default_timeout=timeout,
+            local_size=config.get('CACHE_LOCAL_SIZE', 256),
+            local_timeout=config.get('CACHE_LOCAL_TIMEOUT', 5),
+            stale_timeout=config.get('CACHE_STALE_TIMEOUT', 30),
+            lock_timeout=config.get('CACHE_LOCK_TIMEOUT', 10)
+        )
+
+    def _count(self, result):
+        metrics.record_cache(result)
+
+    def _local_get(self, key):
+        with self.lock:
+            entry = self.local.get(key, None)
+            if entry is None:
+                return None
+
+            value, fresh_until = entry
+            if time.time() >= fresh_until:
+                self.local.pop(key, None)
+                return None
+
+            self.local.move_to_end(key)
+            return value
+
+    def _local_set(self, key, value, fresh_until):
+        if self.local_size <= 0:
+            return
+
+        fresh_until = min(fresh_until, time.time() + self.local_timeout)
+        with self.lock:
+            self.local[key] = (value, fresh_until)
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def _held(self):
+        if not hasattr(self.held, 'keys'):
+            self.held.keys = set()
+
+        return self.held.keys
+
+    def _acquire(self, key):
+        try:
+            acquired = self.shared.add(f'{key}:rebuild', os.getpid(), timeout=self.lock_timeout)
+        except Exception as _exc:    # noqa: F841
+            return True
+
+        if acquired:
+            self._held().add(key)
+
+        return acquired
+
+    def _release(self, key):
+        self._held().discard(key)
+        try:
+            self.shared.delete(f'{key}:rebuild')
+        except Exception as _exc:    # noqa: F841
+            pass
+
+    def _locked(self, key):
+        try:
+            return self.shared.has(f'{key}:rebuild')
+        except Exception as _exc:    # noqa: F841
+            return False
+
+    def release_rebuilds(self):
+        """
+        Let go of any rebuild locks this thread took but never wrote back
+        """
+
+        for key in list(self._held()):
+            self._release(key)
+
+    def get(self, key):
+        value = self._local_get(key)
+        if value is not None:
+            self._count('local')
+            return value
+
+        envelope = self.shared.get(key)
+        if envelope is not None:
+            value, fresh_until = envelope
+            if time.time() < fresh_until:
+                self._count('shared')
+                self._local_set(key, value, fresh_until)
+                return value
+
+            if self._acquire(key):
+                self._count('expired')
+                return None
+
+            self._count('stale')
+            return value
+
+        if self._acquire(key):
+            self._count('miss')
+            return None
+
+        deadline = time.time() + self.wait
+        while time.time() < deadline:
+            time.sleep(0.05)
+            envelope = self.shared.get(key)
+            if envelope is not None:
+                self._count('waited')
+                return envelope[0]
+
+            # The rebuild was given up, or its lock expired, without writing anything back; there's
+            # nothing to wait for, so take over the rebuild
+            if not self._locked(key) and self._acquire(key):
+                break
+
+        self._count('miss')
+        return None
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        fresh_until = time.time() + timeout if timeout else math.inf
+        shared_timeout = timeout + self.stale_timeout if timeout else 0
+
+        self._local_set(key, value, fresh_until)
+        try:
+            return self.shared.set(key, (value, fresh_until), timeout=shared_timeout)
+        finally:
+            self._release(key)
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+
+        return self.set(key, value, timeout=timeout)
+
+    def has(self, key):
+        if self._local_get(key) is not None:
+            return True
+
+        envelope = self.shared.get(key)
+        return envelope is not None and time.time() < envelope[1]
+
+    def delete(self, key):
+        with self.lock:
+            self.local.pop(key, None)
+
+        return self.shared.delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.local.clear()
+
+        return self.shared.clear()
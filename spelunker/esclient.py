@@ -0,0 +1,180 @@
+# pylint: disable=global-statement
+"""
+WoePlanet shared, per-worker Elasticsearch client
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+
+from spelunker import metrics
+
+try:
+    from elasticsearch import AIOHttpConnection
+
+except ImportError as _exc:    # noqa: F841
+    AIOHttpConnection = None
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def response_size(headers, data):
+    """
+    Get the size of a response body, preferring the (on the wire) Content-Length
+    """
+
+    try:
+        return int(headers.get('content-length'))
+    except (AttributeError, TypeError, ValueError) as _exc:    # noqa: F841
+        return len(data) if data else 0
+
+
+class InstrumentedConnection(Urllib3HttpConnection):
+    """
+    Elasticsearch connection that records the size of every response body
+    """
+
+    def perform_request(self, *args, **kwargs):    # pylint: disable=signature-differs
+        status, headers, data = super().perform_request(*args, **kwargs)
+        metrics.record_bytes(response_size(headers, data))
+        return status, headers, data
+
+
+if AIOHttpConnection is not None:
+    class InstrumentedAIOHttpConnection(AIOHttpConnection):
+        """
+        AsyncElasticsearch connection that records the size of every response body
+        """
+
+        async def perform_request(self, *args, **kwargs):    # pylint: disable=signature-differs
+            status, headers, data = await super().perform_request(*args, **kwargs)
+            metrics.record_bytes(response_size(headers, data))
+            return status, headers, data
+
+
+def client_config():
+    """
+    Get the Elasticsearch client configuration from the environment
+    """
+
+    return {
+        'host': os.environ.get('WOE_ES_HOST', 'localhost'),
+        'port': os.environ.get('WOE_ES_PORT', '9200'),
+        'maxsize': int(os.environ.get('WOE_ES_POOL_SIZE', '10')),
+        'timeout': float(os.environ.get('WOE_ES_TIMEOUT', '30')),
+        'retries': int(os.environ.get('WOE_ES_RETRIES', '10')),
+        'keepalive': os.environ.get('WOE_ES_KEEPALIVE', 'true').lower() in ('1', 'true', 'yes')
+    }
+
+
+def get_client():
+    """
+    Get the shared Elasticsearch client for this process, creating it on first use
+
+    The client is keyed on the process id so that a client inherited across a fork (e.g. a gunicorn
+    master with --preload) is never shared with, and its sockets never reused by, a worker
+    """
+
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            config = client_config()
+            headers = {}
+            if not config['keepalive']:
+                headers['connection'] = 'close'
+
+            _client = Elasticsearch(
+                [f"{config['host']}:{config['port']}"],
+                timeout=config['timeout'],
+                max_retries=config['retries'],
+                retry_on_timeout=True,
+                maxsize=config['maxsize'],
+                headers=headers,
+                connection_class=InstrumentedConnection
+            )
+            _client_pid = pid
+
+    return _client
+
+
+def get_async_client():
+    """
+    Get the shared AsyncElasticsearch client for the running event loop, creating it on first use
+
+    The async client's connection pool (an aiohttp session) is bound to the event loop it was created
+    on, so there's one client per loop rather than per process. Needs the `elasticsearch[async]` extra
+    """
+
+    from elasticsearch import AsyncElasticsearch    # pylint: disable=import-outside-toplevel
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop, None)
+    if client is None:
+        config = client_config()
+        headers = {}
+        if not config['keepalive']:
+            headers['connection'] = 'close'
+
+        client = AsyncElasticsearch(
+            [f"{config['host']}:{config['port']}"],
+            timeout=config['timeout'],
+            max_retries=config['retries'],
+            retry_on_timeout=True,
+            maxsize=config['maxsize'],
+            headers=headers,
+            connection_class=InstrumentedAIOHttpConnection
+        )
+        _async_clients[loop] = client
+
+    return client
+
+
+async def close_async_client():
+    """
+    Close the AsyncElasticsearch client for the running event loop, if there is one
+    """
+
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+def pool_stats():
+    """
+    Get connection pool statistics for the shared client
+
+    `requests` counts HTTP requests made over the pool, `connections` counts new TCP connections the
+    pool had to open; the difference is the number of requests that reused a pooled connection
+    """
+
+    stats = {
+        'pid': os.getpid(),
+        'requests': 0,
+        'connections': 0,
+        'hits': 0
+    }
+
+    if _client is None or _client_pid != os.getpid():
+        return stats
+
+    for conn in _client.transport.connection_pool.connections:
+        pool = getattr(conn, 'pool', None)
+        if pool is None:
+            continue
+
+        stats['requests'] += pool.num_requests
+        stats['connections'] += pool.num_connections
+
+    stats['hits'] = max(stats['requests'] - stats['connections'], 0)
+    return stats
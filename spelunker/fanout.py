@@ -0,0 +1,58 @@
+# pylint: disable=global-statement
+"""
+WoePlanet concurrent fan-out of independent backend calls within a request
+"""
+
+import concurrent.futures
+import contextvars
+import os
+import threading
+
+THREAD_PREFIX = 'fanout'
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Get the shared thread pool for this process, creating it on first use
+    """
+
+    global _executor, _executor_pid
+
+    pid = os.getpid()
+    if _executor is not None and _executor_pid == pid:
+        return _executor
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != pid:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=int(os.environ.get('WOE_FANOUT_WORKERS', '8')),
+                thread_name_prefix=THREAD_PREFIX
+            )
+            _executor_pid = pid
+
+    return _executor
+
+
+def fanout(*calls):
+    """
+    Run independent callables concurrently and return their results, in order
+
+    Each callable runs in a copy of the caller's context, so it sees the same Flask request, app
+    context and `flask.g` as the caller. The first callable runs in the calling thread; calls made
+    from inside a fan-out (or when there's only one callable) run serially, so the pool can't be
+    exhausted by fan-outs waiting on each other. Exceptions are re-raised in the caller.
+    """
+
+    if len(calls) < 2 or threading.current_thread().name.startswith(THREAD_PREFIX):
+        return [call() for call in calls]
+
+    executor = get_executor()
+    futures = [executor.submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    results = [calls[0]()]
+    results.extend(future.result() for future in futures)
+
+    return results
@@ -0,0 +1,54 @@
+# pylint: disable=broad-exception-caught
+"""
+WoePlanet index generation marker
+"""
+
+import logging
+import os
+import threading
+import time
+
+from spelunker import esclient
+
+logger = logging.getLogger('gunicorn.error')
+
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+def index_generation(index, **kwargs):
+    """
+    Get an opaque marker that changes whenever an index (or the index an alias points to) is rebuilt
+
+    The marker is made up of the name and UUID of each concrete index behind `index`; it's looked up
+    at most once every `refresh` seconds per process. If Elasticsearch can't be asked, the last known
+    marker is kept; if there has never been one, `unknown` is returned.
+    """
+
+    refresh = kwargs.get('refresh', int(os.environ.get('WOE_GENERATION_REFRESH', '60')))
+    now = time.time()
+
+    generation, checked = _generations.get(index, (None, 0))
+    if generation and now - checked < refresh:
+        return generation
+
+    with _generations_lock:
+        generation, checked = _generations.get(index, (None, 0))
+        if generation and now - checked < refresh:
+            return generation
+
+        try:
+            client = kwargs.get('client', None) or esclient.get_client()
+            rsp = client.indices.get_settings(index=index, name='index.uuid')
+            markers = []
+            for name, settings in sorted(rsp.items()):
+                markers.append(f"{name}:{settings['settings']['index']['uuid']}")
+            generation = ','.join(markers)
+
+        except Exception as exc:
+            logger.warning('Unable to get index generation for %s: %s', index, exc)
+
+        generation = generation or 'unknown'
+        _generations[index] = (generation, now)
+
+    return generation
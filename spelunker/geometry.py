@@ -0,0 +1,402 @@
+# pylint: disable=broad-exception-caught,global-statement
+"""
+WoePlanet multi-resolution geometry
+
+A place's polygons are simplified, once, to each of a handful of zoom levels, and each level is
+written to an on-disk cache as a ready to serve GeoJSON Feature, keyed by index generation. A map
+then only ever loads the detail it can actually draw, and never waits on simplifying it.
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger('gunicorn.error')
+
+# The zoom levels geometry is simplified for; a map at any other zoom gets the next level up, so it
+# never gets less detail than it can draw
+LEVELS = (2, 5, 8, 11, 14)
+
+# Web mercator tiles are 256 pixels square; a vertex that moves less than half a pixel is invisible
+TILE_SIZE = 256
+PIXEL_TOLERANCE = 0.5
+
+POLYGONAL = ('Polygon', 'MultiPolygon', 'LineString', 'MultiLineString')
+
+_cache = None
+
+
+def zoom_level(zoom):
+    """
+    Get the precomputed level to serve for a map zoom, or the finest level if there's no zoom
+    """
+
+    if not isinstance(zoom, int):
+        return LEVELS[-1]
+
+    for level in LEVELS:
+        if zoom <= level:
+            return level
+
+    return LEVELS[-1]
+
+
+def tolerance(level):
+    """
+    Get the simplification tolerance, in degrees, for a zoom level
+    """
+
+    return PIXEL_TOLERANCE * 360.0 / (TILE_SIZE * 2 ** level)
+
+
+def precision(level):
+    """
+    Get the number of decimal places worth keeping in a coordinate at a zoom level
+    """
+
+    return max(0, math.ceil(-math.log10(tolerance(level))))
+
+
+def simplify(geometry, level):
+    """
+    Simplify a GeoJSON geometry for a zoom level, returning None if nothing of it would be visible;
+    points are left to the map's centroid and bounds, so they're always None
+    """
+
+    if not geometry or geometry.get('type', None) not in POLYGONAL:
+        return None
+
+    epsilon = tolerance(level)
+    places = precision(level)
+    kind = geometry['type']
+    coords = geometry.get('coordinates', [])
+
+    if kind == 'LineString':
+        coords = simplify_line(coords, epsilon, places)
+
+    elif kind == 'MultiLineString':
+        coords = [line for line in (simplify_line(line, epsilon, places) for line in coords) if line]
+        if len(coords) == 1:
+            kind, coords = 'LineString', coords[0]
+
+    elif kind == 'Polygon':
+        coords = simplify_polygon(coords, epsilon, places)
+
+    else:
+        coords = [poly for poly in (simplify_polygon(poly, epsilon, places) for poly in coords) if poly]
+        if len(coords) == 1:
+            kind, coords = 'Polygon', coords[0]
+
+    if not coords:
+        return None
+
+    return {
+        'type': kind,
+        'coordinates': coords
+    }
+
+
+def simplify_polygon(rings, epsilon, places):
+    """
+    Simplify a polygon's rings, dropping holes that collapse; returns an empty list if the exterior
+    ring collapses
+    """
+
+    simplified = []
+    for idx, ring in enumerate(rings):
+        ring = simplify_line(ring, epsilon, places)
+        if len(ring) < 4:
+            if idx == 0:
+                return []
+            continue
+
+        simplified.append(ring)
+
+    return simplified
+
+
+def simplify_line(points, epsilon, places):
+    """
+    Simplify a line (or ring) with Douglas-Peucker, then round its coordinates and drop any
+    duplicate vertices the rounding leaves
+    """
+
+    if len(points) < 3:
+        keep = points
+
+    else:
+        keep = [points[idx] for idx in douglas_peucker(points, epsilon)]
+
+    line = []
+    for point in keep:
+        point = [round(point[0], places), round(point[1], places)]
+        if not line or point != line[-1]:
+            line.append(point)
+
+    if len(line) < 2:
+        return []
+
+    return line
+
+
+def douglas_peucker(points, epsilon):
+    """
+    Get the indices of the vertices of a line to keep, without recursion, as rings can run to
+    hundreds of thousands of vertices
+    """
+
+    last = len(points) - 1
+    keep = [False] * len(points)
+    keep[0] = keep[last] = True
+
+    stack = [(0, last)]
+    while stack:
+        first, end = stack.pop()
+        if end - first < 2:
+            continue
+
+        far, dist = farthest(points, first, end)
+        if dist > epsilon:
+            keep[far] = True
+            stack.append((first, far))
+            stack.append((far, end))
+
+    return [idx for idx, kept in enumerate(keep) if kept]
+
+
+def farthest(points, first, end):
+    """
+    Find the vertex between two others that's farthest from the line joining them, or from the
+    first of them if they coincide, as a closed ring's endpoints do
+    """
+
+    x1, y1 = points[first][0], points[first][1]
+    dx = points[end][0] - x1
+    dy = points[end][1] - y1
+
+    far = first
+    most = -1.0
+    if dx == 0 and dy == 0:
+        for idx in range(first + 1, end):
+            point = points[idx]
+            dist = (point[0] - x1) ** 2 + (point[1] - y1) ** 2
+            if dist > most:
+                far, most = idx, dist
+
+        return far, math.sqrt(most)
+
+    # The vertex farthest from the line has the largest cross product with it, which saves a
+    # square root and a division per vertex
+    for idx in range(first + 1, end):
+        point = points[idx]
+        dist = abs(dy * (point[0] - x1) - dx * (point[1] - y1))
+        if dist > most:
+            far, most = idx, dist
+
+    return far, most / math.hypot(dx, dy)
+
+
+def features(doc):
+    """
+    Build the GeoJSON Feature for each zoom level of a document's geometry, serialised ready to serve
+    """
+
+    woeid = doc['woe:id']
+    geometry = doc.get('geometry', None)
+    bbox = doc.get('geom:bbox', [])
+
+    # Each level is simplified from the next finer one, which is already far smaller than the original
+    simplified = {}
+    for level in reversed(LEVELS):
+        geometry = simplify(geometry, level)
+        simplified[level] = geometry
+
+    levels = {}
+    for level in LEVELS:
+        feature = {
+            'type': 'Feature',
+            'id': woeid,
+            'properties': {
+                'woe:id': woeid,
+                'zoom': level
+            },
+            'bbox': bbox,
+            'geometry': simplified[level]
+        }
+        levels[level] = json.dumps(feature, separators=(',', ':')).encode('utf-8')
+
+    return levels
+
+
+class GeometryCache:
+    """
+    An on-disk cache of simplified geometry, one file per place per zoom level, under a directory
+    for each index generation so a rebuilt index never serves stale shapes
+
+    Only one process at a time builds a place's levels, holding a lock file alongside them; a lock
+    older than `lock_timeout` seconds is taken to belong to a build that died. Directories for other
+    generations are never read again, and are removed with `prune()`.
+    """
+
+    def __init__(self, root, **kwargs):
+        self.root = root
+        self.shards = kwargs.get('shards', 1000)
+        self.lock_timeout = kwargs.get('lock_timeout', 120)
+        self.wait = kwargs.get('wait', 1.0)
+
+    def path(self, generation, woeid, level):
+        """
+        Get the path of a cached level
+        """
+
+        shard = f'{int(woeid) % self.shards:03d}'
+        return os.path.join(self.root, str(generation), shard, str(woeid), f'{level}.json')
+
+    def lock_path(self, generation, woeid):
+        """
+        Get the path of the lock file for building a place's levels
+        """
+
+        return os.path.join(os.path.dirname(self.path(generation, woeid, LEVELS[0])), '.lock')
+
+    def lock(self, generation, woeid):
+        """
+        Take the lock on building a place's levels, returning False if another build holds it
+        """
+
+        if not self.root:
+            return True
+
+        path = self.lock_path(generation, woeid)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            for _attempt in range(2):
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+                    return True
+
+                except FileExistsError:
+                    try:
+                        if time.time() - os.path.getmtime(path) < self.lock_timeout:
+                            return False
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+
+            return False
+
+        except Exception as exc:
+            logger.warning('Unable to lock geometry for %s: %s', woeid, exc)
+            return True
+
+    def unlock(self, generation, woeid):
+        """
+        Let go of the lock on building a place's levels
+        """
+
+        if not self.root:
+            return
+
+        try:
+            os.unlink(self.lock_path(generation, woeid))
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            logger.warning('Unable to unlock geometry for %s: %s', woeid, exc)
+
+    def wait_for(self, generation, woeid, level):
+        """
+        Wait up to `wait` seconds for another build to write a level, returning None if it doesn't
+        """
+
+        deadline = time.time() + self.wait
+        while time.time() < deadline:
+            time.sleep(0.05)
+            data = self.read(generation, woeid, level)
+            if data is not None:
+                return data
+
+        return None
+
+    def prune(self, generation):
+        """
+        Remove the cached geometry for every index generation but the given one, returning the
+        generations removed
+        """
+
+        if not self.root or not os.path.isdir(self.root):
+            return []
+
+        removed = []
+        for entry in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, entry)
+            if entry != str(generation) and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(entry)
+
+        return removed
+
+    def read(self, generation, woeid, level):
+        """
+        Read a cached level, returning None if it hasn't been cached
+        """
+
+        if not self.root:
+            return None
+
+        try:
+            with open(self.path(generation, woeid, level), 'rb') as ifh:
+                return ifh.read()
+
+        except FileNotFoundError:
+            return None
+
+        except Exception as exc:
+            logger.warning('Unable to read cached geometry for %s: %s', woeid, exc)
+            return None
+
+    def write(self, generation, woeid, levels):
+        """
+        Write every level of a place's geometry, each atomically, so a concurrent reader never sees
+        half a file
+        """
+
+        if not self.root:
+            return
+
+        try:
+            for level, data in levels.items():
+                path = self.path(generation, woeid, level)
+                dirname = os.path.dirname(path)
+                os.makedirs(dirname, exist_ok=True)
+
+                fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.geometry-')
+                try:
+                    with os.fdopen(fd, 'wb') as ofh:
+                        ofh.write(data)
+                    os.chmod(tmp, 0o644)
+                    os.replace(tmp, path)
+
+                except Exception:
+                    os.unlink(tmp)
+                    raise
+
+        except Exception as exc:
+            logger.warning('Unable to cache geometry for %s: %s', woeid, exc)
+
+
+def geometry_cache():
+    """
+    Get the geometry cache for this process, creating it on first use
+    """
+
+    global _cache
+
+    if _cache is None:
+        _cache = GeometryCache(os.environ.get('WOE_GEOMETRY_CACHE', './data-stores/spelunker/geometry'))
+
+    return _cache
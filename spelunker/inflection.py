@@ -0,0 +1,73 @@
+# pylint: disable=global-statement
+"""
+WoePlanet per-worker inflect engine, with memoised plurals and indefinite articles
+"""
+
+import functools
+import threading
+
+import inflect
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def engine():
+    """
+    Get the inflect engine for this process, creating it on first use
+    """
+
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                words = inflect.engine()
+                words.defnoun('miscellaneous', 'miscellaneous')
+                words.defnoun('county', 'counties')
+                _engine = words
+
+    return _engine
+
+
+def plural(word, count=None):
+    """
+    Pluralise a word, for `count` of them if given
+    """
+
+    # inflect only distinguishes one from many (and, classically, zero), so the cache is keyed on
+    # that rather than on every count a page shows
+    if isinstance(count, int) and count not in (0, 1):
+        count = 2
+
+    return _plural(word, count)
+
+
+@functools.lru_cache(maxsize=1024)
+def _plural(word, count):
+    words = engine()
+    with _engine_lock:
+        return words.plural(word, count)
+
+
+@functools.lru_cache(maxsize=1024)
+def an(word):
+    """
+    Prefix a word with the right indefinite article
+    """
+
+    words = engine()
+    with _engine_lock:
+        return words.an(word)
+
+
+def warm(words):
+    """
+    Memoise the plurals and indefinite articles of a vocabulary, such as the placetype names
+    """
+
+    for word in words:
+        if word:
+            plural(word)
+            plural(word, 2)
+            an(word)
@@ -0,0 +1,506 @@
+# pylint: disable=broad-exception-caught,global-statement
+"""
+WoePlanet per-request backend instrumentation and Prometheus metrics
+
+Each worker keeps its own totals. With a metrics directory configured, every worker also writes them
+to a file there, and whichever worker is scraped renders the sum of them all, so a scrape through the
+shared port sees the whole server rather than one worker. Totals for workers that have exited are
+folded into an archive file, so counters never go backwards when a worker is recycled.
+"""
+
+import collections
+import contextvars
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CACHE_HITS = ('local', 'shared', 'stale', 'waited')
+
+ARCHIVE = 'archive.json'
+
+logger = logging.getLogger('gunicorn.error')
+
+_current = contextvars.ContextVar('spelunker_request_stats', default=None)
+_metrics = None
+_gauges = None
+
+
+class RequestStats:
+    """
+    Backend and cache activity for a single request
+
+    Stats are shared (via the request's context) with any fan-out threads the request starts, so
+    updates are made under a lock
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.backend = collections.Counter()
+        self.cache = collections.Counter()
+        self.took = 0.0
+        self.wall = 0.0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def elapsed(self):
+        """
+        Get the time since the request started, in seconds
+        """
+
+        return time.perf_counter() - self.started
+
+    def cache_hits(self):
+        """
+        Get the number of cache lookups that were served from the cache
+        """
+
+        return sum(count for result, count in self.cache.items() if result in CACHE_HITS)
+
+    def cache_misses(self):
+        """
+        Get the number of cache lookups that weren't served from the cache
+        """
+
+        return sum(count for result, count in self.cache.items() if result not in CACHE_HITS)
+
+    def as_dict(self):
+        """
+        Get the stats as a plain dict, for structured logging
+        """
+
+        return {
+            'duration_ms': round(self.elapsed() * 1000, 2),
+            'backend_calls': sum(self.backend.values()),
+            'backend': dict(self.backend),
+            'es_took_ms': round(self.took * 1000, 2),
+            'es_wall_ms': round(self.wall * 1000, 2),
+            'es_bytes': self.bytes,
+            'cache_hits': self.cache_hits(),
+            'cache_misses': self.cache_misses()
+        }
+
+    def server_timing(self):
+        """
+        Format the stats as a Server-Timing header value
+        """
+
+        calls = sum(self.backend.values())
+        timings = [
+            f'es;dur={self.wall * 1000:.1f};desc="{calls} calls, {self.bytes} bytes"',
+            f'es-took;dur={self.took * 1000:.1f}',
+            f'cache;desc="{self.cache_hits()} hits, {self.cache_misses()} misses"',
+            f'app;dur={self.elapsed() * 1000:.1f}'
+        ]
+
+        return ', '.join(timings)
+
+
+class Metrics:
+    """
+    Request, backend and cache totals, rendered in the Prometheus text exposition format
+
+    With a `path`, this worker's totals (and its gauges) are written to `<path>/<pid>.json` every
+    `interval` seconds and whenever metrics are rendered, and rendering sums every worker's file.
+    """
+
+    def __init__(self, **kwargs):
+        self.path = kwargs.get('path', None)
+        self.interval = kwargs.get('interval', 5)
+        self.pid = os.getpid()
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Increment a counter
+        """
+
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        """
+        Add an observation to a histogram
+        """
+
+        with self.lock:
+            histogram = self.histograms.get((name, labels), None)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(REQUEST_BUCKETS), 'count': 0, 'sum': 0.0}
+                self.histograms[(name, labels)] = histogram
+
+            for idx, bound in enumerate(REQUEST_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][idx] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def snapshot(self, gauges=None):
+        """
+        Get this worker's totals, and any point in time gauges, as a JSON serialisable dict
+        """
+
+        with self.lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, dict(value, buckets=list(value['buckets']))] for (name, labels), value in self.histograms.items()],
+                'gauges': dict(gauges or {})
+            }
+
+    def start(self):
+        """
+        Start writing this worker's totals to the metrics directory periodically, on a daemon thread
+        """
+
+        if not self.path:
+            return
+
+        def flush():
+            while True:
+                self.flush()
+                time.sleep(self.interval)
+
+        thread = threading.Thread(target=flush, name='metrics-flush', daemon=True)
+        thread.start()
+
+    def flush(self, gauges=None):
+        """
+        Write this worker's totals, and its gauges, to the metrics directory
+        """
+
+        if not self.path:
+            return
+
+        if gauges is None and _gauges is not None:
+            try:
+                gauges = _gauges()
+            except Exception as exc:
+                logger.warning('Unable to get metrics gauges: %s', exc)
+
+        try:
+            write_json(os.path.join(self.path, f'{self.pid}.json'), self.snapshot(gauges))
+        except Exception as exc:
+            logger.warning('Unable to write metrics to %s: %s', self.path, exc)
+
+    def collect(self, gauges=None):
+        """
+        Get the totals to render: this worker's, or every worker's (and the archive's) summed
+        """
+
+        if not self.path:
+            return [self.snapshot(gauges)]
+
+        self.flush(gauges)
+
+        # A worker's file is removed only once the archive includes it, so a file that goes missing
+        # while it's being read means the archive read first is out of date; start again
+        for _attempt in range(3):
+            archive = read_json(os.path.join(self.path, ARCHIVE)) or {}
+            merged = set(archive.get('merged', []))
+            snapshots = [archive]
+            complete = True
+            for path in sorted(glob.glob(os.path.join(self.path, '*.json'))):
+                name = os.path.basename(path)
+                if name == ARCHIVE or name in merged:
+                    continue
+
+                snapshot = read_json(path)
+                if snapshot is None:
+                    complete = False
+                    break
+                snapshots.append(snapshot)
+
+            if complete:
+                break
+
+        return snapshots
+
+    def render(self, gauges=None):
+        """
+        Render all metrics, plus any point in time gauges, summed across workers
+        """
+
+        counters, histograms, totals = merge(self.collect(gauges))
+        lines = []
+
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{format_labels(labels)} {value:g}')
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            for bound, count in zip(REQUEST_BUCKETS, histogram['buckets']):
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", f"{bound:g}"),))} {count}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]:g}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+
+        for name, value in sorted(totals.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value:g}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def merge(snapshots):
+    """
+    Sum the counters, histograms and gauges of a list of snapshots
+    """
+
+    counters = collections.defaultdict(float)
+    histograms = {}
+    gauges = collections.defaultdict(float)
+
+    for snapshot in snapshots:
+        for name, labels, value in snapshot.get('counters', []):
+            counters[(name, as_labels(labels))] += value
+
+        for name, labels, value in snapshot.get('histograms', []):
+            key = (name, as_labels(labels))
+            histogram = histograms.get(key, None)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(REQUEST_BUCKETS), 'count': 0, 'sum': 0.0}
+                histograms[key] = histogram
+
+            histogram['buckets'] = [total + count for total, count in zip(histogram['buckets'], value['buckets'])]
+            histogram['count'] += value['count']
+            histogram['sum'] += value['sum']
+
+        for name, value in snapshot.get('gauges', {}).items():
+            gauges[name] += value
+
+    return counters, histograms, gauges
+
+
+def as_labels(labels):
+    """
+    Turn labels read back from JSON into the tuple of pairs they were recorded as
+    """
+
+    return tuple(tuple(pair) for pair in labels)
+
+
+def read_json(path):
+    """
+    Read a metrics file, returning None if it's gone
+    """
+
+    try:
+        with open(path, 'r', encoding='utf-8') as ifh:
+            return json.load(ifh)
+
+    except FileNotFoundError:
+        return None
+
+    except Exception as exc:
+        logger.warning('Unable to read metrics from %s: %s', path, exc)
+        return {}
+
+
+def write_json(path, data):
+    """
+    Write a metrics file atomically, so a concurrent reader never sees half of it
+    """
+
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as ofh:
+            json.dump(data, ofh)
+        os.replace(tmp, path)
+
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def metrics_dir():
+    """
+    Get the directory workers share their metrics through, or None to keep them per process
+    """
+
+    return os.environ.get('WOE_METRICS_DIR', None) or None
+
+
+def reset(path):
+    """
+    Remove every metrics file from a directory, when the server starts
+    """
+
+    if not path:
+        return
+
+    for name in glob.glob(os.path.join(path, '*.json')) + glob.glob(os.path.join(path, '.metrics-*')):
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+
+def archive(path, pid):
+    """
+    Fold the totals of a worker that has exited into the archive, and remove its file
+
+    Gauges are dropped, as they describe a process that no longer exists. The worker's file is listed
+    as merged until it has gone, so nothing reading the directory meanwhile counts it twice.
+    """
+
+    if not path:
+        return
+
+    name = f'{pid}.json'
+    try:
+        snapshot = read_json(os.path.join(path, name))
+        if not snapshot:
+            return
+
+        archived = read_json(os.path.join(path, ARCHIVE)) or {}
+        counters, histograms, _totals = merge([archived, dict(snapshot, gauges={})])
+        data = {
+            'counters': [[key, labels, value] for (key, labels), value in counters.items()],
+            'histograms': [[key, labels, value] for (key, labels), value in histograms.items()]
+        }
+
+        write_json(os.path.join(path, ARCHIVE), dict(data, merged=[name]))
+        os.unlink(os.path.join(path, name))
+        write_json(os.path.join(path, ARCHIVE), data)
+
+    except Exception as exc:
+        logger.warning('Unable to archive metrics for worker %s: %s', pid, exc)
+
+
+def format_labels(labels):
+    """
+    Format metric labels
+    """
+
+    if not labels:
+        return ''
+
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+
+def metrics():
+    """
+    Get the metrics for this process, creating them on first use, and afresh in a forked child
+    """
+
+    global _metrics
+
+    if _metrics is None or _metrics.pid != os.getpid():
+        _metrics = Metrics(path=metrics_dir(), interval=float(os.environ.get('WOE_METRICS_INTERVAL', '5')))
+        _metrics.start()
+
+    return _metrics
+
+
+def register_gauges(provider):
+    """
+    Set the function that gets this worker's point in time gauges, for the periodic metrics writes
+    """
+
+    global _gauges
+
+    _gauges = provider
+
+
+def begin():
+    """
+    Start collecting stats for a new request
+    """
+
+    stats = RequestStats()
+    _current.set(stats)
+    return stats
+
+
+def current():
+    """
+    Get the stats for the current request, or None outside of a request
+    """
+
+    return _current.get()
+
+
+def finish(endpoint, status):
+    """
+    Stop collecting stats for the current request, adding them to the worker's metrics
+    """
+
+    stats = _current.get()
+    if stats is None:
+        return None
+
+    _current.set(None)
+    endpoint = endpoint or 'unmatched'
+    registry = metrics()
+    registry.inc('spelunker_requests_total', (('endpoint', endpoint), ('status', str(status))))
+    registry.observe('spelunker_request_duration_seconds', (('endpoint', endpoint),), stats.elapsed())
+
+    return stats
+
+
+def record_backend(kind, started, took=None):
+    """
+    Record a backend call, started at `started` (a perf_counter), and the `took` (in ms) Elasticsearch
+    reported for it
+    """
+
+    wall = time.perf_counter() - started
+    took = (took or 0) / 1000
+
+    registry = metrics()
+    registry.inc('spelunker_backend_requests_total', (('kind', kind),))
+    registry.inc('spelunker_backend_wall_seconds_total', value=wall)
+    registry.inc('spelunker_backend_took_seconds_total', value=took)
+
+    stats = _current.get()
+    if stats is not None:
+        with stats.lock:
+            stats.backend[kind] += 1
+            stats.wall += wall
+            stats.took += took
+
+
+def record_bytes(nbytes):
+    """
+    Record the size of a backend response body
+    """
+
+    metrics().inc('spelunker_backend_bytes_total', value=nbytes)
+
+    stats = _current.get()
+    if stats is not None:
+        with stats.lock:
+            stats.bytes += nbytes
+
+
+def record_cache(result):
+    """
+    Record the result of a cache lookup: local, shared, stale or waited (hits); expired or miss
+    """
+
+    metrics().inc('spelunker_cache_lookups_total', (('result', result),))
+
+    stats = _current.get()
+    if stats is not None:
+        with stats.lock:
+            stats.cache[result] += 1
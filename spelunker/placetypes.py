@@ -0,0 +1,190 @@
+# pylint: disable=broad-exception-caught,global-statement
+"""
+WoePlanet in-memory placetype registry
+"""
+
+import logging
+import os
+import threading
+import time
+
+from spelunker import esclient
+from spelunker.snapshot import get_snapshot
+
+logger = logging.getLogger('gunicorn.error')
+
+_registry = None
+
+
+class PlacetypeRegistry:
+    """
+    WoePlanet placetypes, loaded once per worker and looked up by id or by shortname
+
+    Only one thread at a time loads the registry. A stale registry keeps being served while it's
+    refreshed on a background thread; only an empty one is loaded in the calling thread.
+    """
+
+    def __init__(self, **kwargs):
+        self.index = kwargs.get('index')
+        self.refresh = kwargs.get('refresh', 3600)
+        self.retry = kwargs.get('retry', 60)
+        self.esclient = kwargs.get('client', None)
+        self.ids = {}
+        self.names = {}
+        self.source = None
+        self.loaded = 0
+        self.lock = threading.Lock()
+        self.loading = threading.Lock()
+
+    def load(self):
+        """
+        (Re)load the registry from the placetypes index; if the index can't be read, the registry
+        keeps what it has or, if it's empty, falls back to the static data snapshot's placetypes and
+        then the placetypes bundled with py-woeplanet-placetypes, and tries the index again after
+        `retry` seconds
+        """
+
+        placetypes = []
+        source = None
+        try:
+            client = self.esclient if self.esclient else esclient.get_client()
+            rsp = client.search(body={'size': 1000, 'query': {'match_all': {}}}, index=self.index)
+            placetypes = [doc['_source'] for doc in rsp['hits']['hits']]
+            source = self.index
+
+        except Exception as exc:
+            logger.warning('Unable to load placetypes from the %s index: %s', self.index, exc)
+
+        if not placetypes and not self.ids:
+            snapshot = get_snapshot()
+            if snapshot and snapshot.registry:
+                placetypes = snapshot.registry
+                source = snapshot.path
+
+            else:
+                placetypes = bundled_placetypes()
+                source = 'bundled'
+
+        self.preload(placetypes, source)
+
+        # A fallback isn't the index; keep trying the index every `retry` seconds until it answers
+        if source != self.index and self.ids:
+            self.loaded = time.time() - self.refresh + self.retry
+
+    def preload(self, placetypes, source):
+        """
+        Load the registry from a list of placetypes, such as those from a static data snapshot
+        """
+
+        ids = {}
+        names = {}
+        for placetype in placetypes:
+            ids[int(placetype['id'])] = placetype
+            names[placetype['shortname'].lower()] = placetype
+
+        with self.lock:
+            if ids or not self.ids:
+                self.ids = ids
+                self.names = names
+                self.source = source
+            self.loaded = time.time()
+
+        logger.info('Loaded %d placetypes from %s', len(self.ids), self.source)
+
+    def invalidate(self):
+        """
+        Mark the registry as stale, forcing a reload on next use
+        """
+
+        self.loaded = 0
+
+    def ensure(self):
+        """
+        Load the registry if it's empty, or start refreshing it if it's stale
+        """
+
+        age = time.time() - self.loaded
+        if self.ids:
+            if age > self.refresh:
+                self.refresh_async()
+            return
+
+        if age > self.retry:
+            with self.loading:
+                if not self.ids and time.time() - self.loaded > self.retry:
+                    self.load()
+
+    def refresh_async(self):
+        """
+        Reload the registry on a background thread, unless it's already being loaded
+        """
+
+        if not self.loading.acquire(blocking=False):    # pylint: disable=consider-using-with
+            return
+
+        def refresh():
+            try:
+                self.load()
+            finally:
+                self.loading.release()
+
+        thread = threading.Thread(target=refresh, name='placetype-refresh', daemon=True)
+        thread.start()
+
+    def by_id(self, ptid):
+        """
+        Get a placetype by id
+        """
+
+        self.ensure()
+        try:
+            return self.ids.get(int(ptid), None)
+        except (TypeError, ValueError) as _exc:    # noqa: F841
+            return None
+
+    def by_name(self, name):
+        """
+        Get a placetype by shortname
+        """
+
+        self.ensure()
+        if not name:
+            return None
+
+        return self.names.get(name.lower(), None)
+
+
+def placetype_registry():
+    """
+    Get the placetype registry for this process, creating it on first use
+    """
+
+    global _registry
+
+    if _registry is None:
+        _registry = PlacetypeRegistry(
+            index=os.environ.get('WOE_ES_PT_INDEX', 'placetypes'),
+            refresh=int(os.environ.get('WOE_PT_REFRESH', '3600'))
+        )
+
+    return _registry
+
+
+def bundled_placetypes():
+    """
+    Get the placetypes bundled with py-woeplanet-placetypes, in the same form as the placetypes index
+    """
+
+    try:
+        from woeplanet.placetypes import placetypes    # pylint: disable=import-outside-toplevel
+        return [
+            {
+                'id': int(placetype['id']),
+                'name': placetype['name'],
+                'shortname': placetype['shortname']
+            } for placetype in placetypes()
+        ]
+
+    except Exception as exc:
+        logger.warning('Unable to load bundled placetypes: %s', exc)
+        return []
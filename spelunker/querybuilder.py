@@ -0,0 +1,143 @@
+"""
+WoePlanet compiled query filters
+
+Filter fragments are built once per distinct combination of includes and excludes (placetypes are
+checked against the registry every time); queries share the fragments, which must never be mutated. Filters are all non-scoring, and
+go in the `filter` and `must_not` clauses, so Elasticsearch can cache them.
+"""
+
+import collections
+import functools
+
+import flask
+
+from spelunker.placetypes import placetype_registry
+
+# Exclusions for pages listing places
+EXCLUDE_DEFAULT = {
+    'placetypes': [0],
+    'nullisland': True,
+    'deprecated': True
+}
+
+# Exclusions for pages listing nearby or random places, which also leave out postcodes and zones
+EXCLUDE_PLACES = {
+    'placetypes': [0, 11, 25],
+    'nullisland': True,
+    'deprecated': True
+}
+
+CENTROID = (
+    {'exists': {'field': 'woe:latitude'}},
+    {'exists': {'field': 'woe:longitude'}}
+)
+NULLISLAND = (
+    {'term': {'geom:latitude': {'value': 0.0}}},
+    {'term': {'geom:longitude': {'value': 0.0}}}
+)
+PLANET = {'term': {'woe:id': {'value': 1}}}
+DEPRECATED = {'exists': {'field': 'woe:superseded_by'}}
+
+Filters = collections.namedtuple('Filters', ['filter', 'must_not'])
+
+
+def compile_filters(includes, excludes):
+    """
+    Get the compiled filters for a set of includes and excludes, aborting the request if any of the
+    placetypes are unknown
+    """
+
+    includes = includes or {}
+    excludes = excludes or {}
+    placetypes = tuple(includes.get('placetypes', []) or [])
+    not_placetypes = tuple(excludes.get('placetypes', []) or [])
+
+    # Placetypes are checked on every call, not just when the filters are compiled, as the registry
+    # they're checked against can change (or still be empty)
+    validate_placetypes(placetypes, 'include')
+    validate_placetypes(not_placetypes, 'exclude')
+
+    return _compile(
+        bool(includes.get('centroid', False)),
+        bool(includes.get('nullisland', False)),
+        placetypes,
+        not_placetypes,
+        bool(excludes.get('nullisland', False)),
+        bool(excludes.get('deprecated', False))
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(centroid, nullisland, placetypes, not_placetypes, not_nullisland, not_deprecated):    # pylint: disable=too-many-arguments
+    must = []
+    must_not = []
+
+    if centroid:
+        must.extend(CENTROID)
+
+    if nullisland:
+        must.extend(NULLISLAND)
+        must_not.append(PLANET)
+        must_not.append(DEPRECATED)
+
+    if placetypes:
+        must.append(placetype_term(placetypes))
+
+    if not_placetypes:
+        must_not.append(placetype_term(not_placetypes))
+
+    if not_nullisland:
+        must_not.extend(NULLISLAND)
+
+    if not_deprecated:
+        must_not.append(DEPRECATED)
+
+    return Filters(
+        filter=tuple(must),
+        must_not=tuple(must_not)
+    )
+
+
+def placetype_filter(placetypes, mode):
+    """
+    Build a placetype filter, aborting the request if any of the placetypes are unknown
+    """
+
+    validate_placetypes(placetypes, mode)
+    return placetype_term(placetypes)
+
+
+def validate_placetypes(placetypes, mode):
+    """
+    Abort the request if any of the placetypes are unknown; if the registry couldn't be loaded at
+    all, placetypes can't be checked, so they're taken on trust
+    """
+
+    if not placetypes:
+        return
+
+    registry = placetype_registry()
+    registry.ensure()
+    if not registry.ids:
+        flask.current_app.logger.warning('Placetype registry is empty; not checking %s placetypes %s', mode, list(placetypes))
+        return
+
+    for place_type in placetypes:
+        if not registry.by_id(place_type):
+            flask.current_app.logger.warning(
+                'Invalid enfilter:%s:placetype %s',
+                mode,
+                place_type
+            )
+            flask.abort(404)
+
+
+def placetype_term(placetypes):
+    """
+    Build the query term for a set of placetypes
+    """
+
+    if len(placetypes) == 1:
+        return {'term': {'woe:placetype': placetypes[0]}}
+
+    return {'terms': {'woe:placetype': list(placetypes)}}
@@ -3,10 +3,17 @@
 WoePlanet Elasticsearch connection and query wrangling
 """
 
+import base64
+import binascii
+import copy
+import json
 import math
+import time
 
 import flask
-from elasticsearch import Elasticsearch, TransportError
+from elasticsearch import TransportError, helpers
+
+from spelunker import esclient, metrics
 
 
 class QueryManager:
@@ -15,27 +22,42 @@ class QueryManager:
     """
 
     def __init__(self, **kwargs):
-        self.host = kwargs.get('host')
-        self.port = kwargs.get('port')
         self.index = kwargs.get('index')
-        self.timeout = kwargs.get('timeout', 30)
-        self.retries = kwargs.get('retries', 10)
+        self.timeout = kwargs.get('timeout', esclient.client_config()['timeout'])
         self.per_page = kwargs.get('per_page', 10)
         self.per_page_max = kwargs.get('per_page_max', 20)
         self.page = 1
 
-        self.esclient = Elasticsearch(
-            [f'{self.host}:{self.port}'],
-            timeout=self.timeout,
-            max_retries=self.retries,
-            retry_on_timeout=True
-        )
+        self.esclient = kwargs.get('client', None)
+        if not self.esclient:
+            self.esclient = esclient.get_client()
 
     def query(self, **kwargs):
         """
         Do the query thing ...
         """
 
+        body, reverse = self.prepare_query(**kwargs)
+
+        started = time.perf_counter()
+        try:
+            rsp = self.esclient.search(body=body, index=self.index, request_timeout=self.timeout, **self.search_params(body))
+
+        except Exception as exc:
+            metrics.record_backend('search', started)
+            return self.error_rsp(exc)
+
+        metrics.record_backend('search', started, took=rsp.get('took', None))
+
+        return self.search_rsp(rsp, reverse=reverse)
+
+    def prepare_query(self, **kwargs):
+        """
+        Apply pagination (a search_after cursor token, or a page number) to a search body
+
+        Returns the body and whether the hits will come back in reverse order and need flipping
+        """
+
         page = self.page
         per_page = self.per_page
 
@@ -49,9 +71,22 @@ class QueryManager:
         if params.get('page', None):
             page = params['page']
 
+        token = params.get('token', None)
+        cursor = self.decode_token(token=token) if token else None
+        reverse = False
         after = params.get('after', False)
         es_params = {}
-        if after:
+        if cursor:
+            page = cursor['page']
+            params['page'] = page
+            body['search_after'] = cursor['after']
+            if 'size' not in body:
+                body['size'] = per_page
+            if cursor.get('prev', False):
+                reverse = True
+                body['sort'] = self.reverse_sort(body.get('sort', []))
+
+        elif after:
             if params.get('page', None):
                 page = params['page']
 
@@ -63,23 +98,205 @@ class QueryManager:
                 if 'size' not in body:
                     body['size'] = es_params['size']
 
-        try:
-            rsp = self.esclient.search(body=body, index=self.index)
+        return body, reverse
 
-        except TransportError as exc:
-            flask.current_app.logger.error('ElasticSearch transport error: %s', exc)
-            rsp = exc.info
-        except Exception as exc:
-            flask.current_app.logger.error('Other error: %s', exc)
-            rsp = {
-                'status': 500
+    def search_params(self, body):
+        """
+        Get the query string parameters for a search: facet-only (`size: 0`) searches are served from
+        the shard request cache, which is invalidated whenever the index is refreshed
+        """
+
+        if body.get('size', None) == 0:
+            return {
+                'request_cache': 'true'
             }
-        else:
-            rsp['status'] = 200
+
+        return {}
+
+    def search_rsp(self, rsp, **kwargs):
+        """
+        Mark a successful search response, putting reversed hits back in order
+        """
+
+        rsp['status'] = 200
+        if kwargs.get('reverse', False):
+            rsp['hits']['hits'].reverse()
 
         # flask.current_app.logger.debug('rsp: %s', rsp)
         return rsp
 
+    def error_rsp(self, exc):
+        """
+        Log a failed backend request and turn it into an error response
+        """
+
+        if isinstance(exc, TransportError):
+            flask.current_app.logger.error('ElasticSearch transport error: %s', exc)
+            return exc.info
+
+        flask.current_app.logger.error('Other error: %s', exc)
+        return {
+            'status': 500
+        }
+
+    def msearch(self, searches):
+        """
+        Do a batch of query things in a single round trip ...
+
+        Each search is a dict of the keyword arguments `query` takes; the responses come back in the
+        same order, each as `query` would have returned it
+        """
+
+        lines, reverses = self.msearch_body(searches)
+
+        started = time.perf_counter()
+        try:
+            rsp = self.esclient.msearch(body=lines, index=self.index, request_timeout=self.timeout)
+
+        except Exception as exc:
+            metrics.record_backend('msearch', started)
+            error = self.error_rsp(exc)
+            return [error for _search in searches]
+
+        metrics.record_backend('msearch', started, took=rsp.get('took', None))
+
+        return self.msearch_rsp(rsp, reverses)
+
+    def msearch_body(self, searches):
+        """
+        Build the header and body lines of a multi-search, applying pagination to each search
+
+        Returns the lines and, for each search, whether its hits will come back in reverse order
+        """
+
+        lines = []
+        reverses = []
+        for search in searches:
+            body, reverse = self.prepare_query(**search)
+            header = {'index': self.index}
+            header.update(self.search_params(body))
+            lines.extend([header, body])
+            reverses.append(reverse)
+
+        return lines, reverses
+
+    def msearch_rsp(self, rsp, reverses):
+        """
+        Split a multi-search response into one response per search
+        """
+
+        responses = []
+        for item, reverse in zip(rsp.get('responses', []), reverses):
+            if 'error' in item:
+                flask.current_app.logger.error('ElasticSearch multi-search error: %s', item['error'])
+                responses.append(item)
+            else:
+                responses.append(self.search_rsp(item, reverse=reverse))
+
+        return responses
+
+    def mget(self, **kwargs):
+        """
+        Do the multi-get thing ...
+        """
+
+        ids = kwargs.get('ids', [])
+        es_params = self.source_params(**kwargs)
+
+        started = time.perf_counter()
+        try:
+            rsp = self.esclient.mget(body={'ids': ids}, index=self.index, request_timeout=self.timeout, **es_params)
+
+        except Exception as exc:
+            metrics.record_backend('mget', started)
+            return self.error_rsp(exc)
+
+        metrics.record_backend('mget', started, took=rsp.get('took', None))
+
+        rsp['status'] = 200
+        return rsp
+
+    def scan(self, **kwargs):
+        """
+        Scroll through all documents matching a query, yielding at most `limit` of them; a backend
+        error partway through is raised
+        """
+
+        body = self.scan_body(kwargs.get('body', {}))
+        size = kwargs.get('size', 500)
+        limit = kwargs.get('limit', None)
+
+        started = time.perf_counter()
+        docs = helpers.scan(
+            self.esclient,
+            query=body,
+            index=self.index,
+            size=size,
+            scroll='1m',
+            request_timeout=self.timeout
+        )
+
+        count = 0
+        try:
+            for doc in docs:
+                if limit is not None and count >= limit:
+                    break
+
+                count += 1
+                yield doc['_source']
+
+        except TransportError as exc:
+            # Re-raise, so a response streaming the documents is cut off rather than closed off
+            # cleanly, and the client can tell it's incomplete
+            flask.current_app.logger.error('ElasticSearch transport error: %s', exc)
+            raise
+
+        finally:
+            docs.close()
+            metrics.record_backend('scan', started)
+
+    def source_params(self, **kwargs):
+        """
+        Build the _source filtering parameters for a multi-get
+        """
+
+        includes = kwargs.get('includes', [])
+        excludes = kwargs.get('excludes', [])
+
+        es_params = {}
+        if includes:
+            es_params['_source_includes'] = includes
+        if excludes:
+            es_params['_source_excludes'] = excludes
+
+        return es_params
+
+    def scan_body(self, body):
+        """
+        Strip a search body of everything a scroll doesn't support
+        """
+
+        for key in ('size', 'from', 'sort', 'aggs', 'track_total_hits'):
+            body.pop(key, None)
+
+        return body
+
+    def found(self, rsp):
+        """
+        Return all documents found by a multi-get
+        """
+
+        try:
+            docs = []
+            for doc in rsp['docs']:
+                if doc.get('found', False):
+                    docs.append(doc['_source'])
+
+            return docs
+
+        except Exception as _exc:    # noqa: F841
+            return []
+
     def single(self, rsp):
         """
         Return a single response document
@@ -208,35 +425,199 @@ class QueryManager:
 
         page = kwargs.get('page', self.page)
         hits = rsp['hits']
-        total = hits['total']['value']
         docs = hits['hits']
         count = len(docs)
 
+        # Totals are exact (eq), a lower bound when counting was capped (gte) or missing when
+        # counting was turned off; treat the latter as a lower bound of what's been seen so far
+        total = per_page * (page - 1) + count
+        relation = 'gte'
+        if hits.get('total', None):
+            total = max(hits['total']['value'], total)
+            relation = hits['total'].get('relation', 'eq')
+
         pages = float(total) / float(per_page)
         pages = math.ceil(pages)
         pages = int(pages)
+        more = page < pages or (relation == 'gte' and count >= per_page)
 
         pagination = {
             'total': total,
+            'relation': relation,
             'count': count,
             'start': per_page * (page - 1) + 1 if page > 1 else 1,
             'per_page': per_page,
             'page': page,
-            'pages': pages
+            'pages': pages,
+            'more': more
         }
 
+        if docs and 'sort' in docs[0]:
+            pagination['tokens'] = {
+                'prev': self.encode_token(token={'after': docs[0]['sort'], 'page': page - 1, 'prev': True}) if page > 1 else None,
+                'next': self.encode_token(token={'after': docs[-1]['sort'], 'page': page + 1}) if more else None
+            }
+
         return pagination
 
-    # def encode_token(self, *, token):
-    #     token_json = json.dumps(token)
-    #     token_jsonb = token_json.encode('utf-8')
-    #     token_jsonb64 = base64.b64encode(token_jsonb)
-    #     token_jsonb64s = token_jsonb64.decode('utf-8')
-    #     return token_jsonb64s
-
-    # def decode_token(self, *, token):
-    #     token_strb = token.encode('utf-8')
-    #     token_decoded = base64.b64decode(token_strb)
-    #     token_decodeds = token_decoded.decode(token_decoded)
-    #     token_json = json.loads(token_decodeds)
-    #     return token_json
+    def reverse_sort(self, sort):
+        """
+        Reverse the order (and the placing of missing values) of a sort, for paging backwards
+        """
+
+        reverse = copy.deepcopy(sort)
+        for clause in reverse:
+            for field, opts in clause.items():
+                if not isinstance(opts, dict):
+                    opts = {'order': opts}
+                    clause[field] = opts
+
+                opts['order'] = 'asc' if opts.get('order', 'asc') == 'desc' else 'desc'
+                opts['missing'] = '_first' if opts.get('missing', '_last') == '_last' else '_last'
+
+        return reverse
+
+    def encode_token(self, *, token):
+        """
+        Encode a search_after cursor as an opaque, URL safe, token
+        """
+
+        token_json = json.dumps(token, separators=(',', ':'))
+        token_jsonb = token_json.encode('utf-8')
+        token_jsonb64 = base64.urlsafe_b64encode(token_jsonb)
+        token_jsonb64s = token_jsonb64.decode('utf-8')
+        return token_jsonb64s.rstrip('=')
+
+    def decode_token(self, *, token):
+        """
+        Decode an opaque token back to a search_after cursor, or None if it isn't a valid token
+        """
+
+        try:
+            token_strb = token.encode('utf-8')
+            token_decoded = base64.urlsafe_b64decode(token_strb + b'=' * (-len(token_strb) % 4))
+            token_decodeds = token_decoded.decode('utf-8')
+            token_json = json.loads(token_decodeds)
+            if not isinstance(token_json.get('after', None), list) or int(token_json.get('page', 0)) < 1:
+                raise ValueError('Malformed cursor')
+
+            token_json['page'] = int(token_json['page'])
+            return token_json
+
+        except (AttributeError, binascii.Error, UnicodeDecodeError, ValueError) as exc:
+            flask.current_app.logger.warning('Ignoring invalid pagination token %s: %s', token, exc)
+            return None
+
+
+class AsyncQueryManager(QueryManager):
+    """
+    WoePlanet Elasticsearch query wrangler for the async serving mode, on AsyncElasticsearch
+
+    Query building, pagination and response formatting are shared with `QueryManager`; only the
+    backend calls are awaitable
+    """
+
+    def __init__(self, **kwargs):
+        if not kwargs.get('client', None):
+            kwargs['client'] = esclient.get_async_client()
+
+        super().__init__(**kwargs)
+
+    async def query(self, **kwargs):
+        """
+        Do the query thing, asynchronously ...
+        """
+
+        body, reverse = self.prepare_query(**kwargs)
+
+        started = time.perf_counter()
+        try:
+            rsp = await self.esclient.search(body=body, index=self.index, request_timeout=self.timeout, **self.search_params(body))
+
+        except Exception as exc:
+            metrics.record_backend('search', started)
+            return self.error_rsp(exc)
+
+        metrics.record_backend('search', started, took=rsp.get('took', None))
+
+        return self.search_rsp(rsp, reverse=reverse)
+
+    async def msearch(self, searches):
+        """
+        Do a batch of query things in a single round trip, asynchronously ...
+        """
+
+        lines, reverses = self.msearch_body(searches)
+
+        started = time.perf_counter()
+        try:
+            rsp = await self.esclient.msearch(body=lines, index=self.index, request_timeout=self.timeout)
+
+        except Exception as exc:
+            metrics.record_backend('msearch', started)
+            error = self.error_rsp(exc)
+            return [error for _search in searches]
+
+        metrics.record_backend('msearch', started, took=rsp.get('took', None))
+
+        return self.msearch_rsp(rsp, reverses)
+
+    async def mget(self, **kwargs):
+        """
+        Do the multi-get thing, asynchronously ...
+        """
+
+        ids = kwargs.get('ids', [])
+        es_params = self.source_params(**kwargs)
+
+        started = time.perf_counter()
+        try:
+            rsp = await self.esclient.mget(body={'ids': ids}, index=self.index, request_timeout=self.timeout, **es_params)
+
+        except Exception as exc:
+            metrics.record_backend('mget', started)
+            return self.error_rsp(exc)
+
+        metrics.record_backend('mget', started, took=rsp.get('took', None))
+
+        rsp['status'] = 200
+        return rsp
+
+    async def scan(self, **kwargs):
+        """
+        Scroll through all documents matching a query, asynchronously yielding at most `limit` of them;
+        a backend error partway through is raised
+        """
+
+        body = self.scan_body(kwargs.get('body', {}))
+        size = kwargs.get('size', 500)
+        limit = kwargs.get('limit', None)
+
+        started = time.perf_counter()
+        docs = helpers.async_scan(
+            self.esclient,
+            query=body,
+            index=self.index,
+            size=size,
+            scroll='1m',
+            request_timeout=self.timeout
+        )
+
+        count = 0
+        try:
+            async for doc in docs:
+                if limit is not None and count >= limit:
+                    break
+
+                count += 1
+                yield doc['_source']
+
+        except TransportError as exc:
+            # Re-raise, so a response streaming the documents is cut off rather than closed off
+            # cleanly, and the client can tell it's incomplete
+            flask.current_app.logger.error('ElasticSearch transport error: %s', exc)
+            raise
+
+        finally:
+            await docs.aclose()
+            metrics.record_backend('scan', started)
@@ -0,0 +1,94 @@
+# pylint: disable=broad-exception-caught
+"""
+WoePlanet per-worker pool of pre-inflated random places
+"""
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('gunicorn.error')
+
+
+class RandomPool:
+    """
+    A pool of random, already inflated, WoePlanet documents that refills itself in bulk
+
+    Documents are handed out once each; when the pool runs low, or its contents are older than
+    `ttl` seconds, a refill is started on a background thread. Only an empty pool is refilled in
+    the calling thread, which waits up to `wait` seconds for any refill already under way.
+    """
+
+    def __init__(self, **kwargs):
+        self.loader = kwargs.get('loader')
+        self.size = kwargs.get('size', 2000)
+        self.low = kwargs.get('low', max(self.size // 10, 1))
+        self.ttl = kwargs.get('ttl', 600)
+        self.wait = kwargs.get('wait', 10)
+        self.docs = []
+        self.loaded = 0
+        self.lock = threading.Lock()
+        self.refilling = threading.Lock()
+
+    def refill(self, **kwargs):
+        """
+        Replace the contents of the pool with a fresh batch of documents; if another refill is under
+        way, either return at once or, if `wait` is given, wait that long for it to finish
+        """
+
+        wait = kwargs.get('wait', None)
+        if wait is None:
+            acquired = self.refilling.acquire(blocking=False)    # pylint: disable=consider-using-with
+        else:
+            acquired = self.refilling.acquire(timeout=wait)    # pylint: disable=consider-using-with
+
+        if not acquired:
+            return
+
+        try:
+            # Whoever held the lock may have just filled the pool
+            if wait is not None and self.docs:
+                return
+
+            docs = self.loader(self.size)
+            if docs:
+                random.shuffle(docs)
+                with self.lock:
+                    self.docs = docs
+                    self.loaded = time.time()
+
+        except Exception as exc:
+            logger.error('Unable to refill random place pool: %s', exc)
+
+        finally:
+            self.refilling.release()
+
+    def refill_async(self):
+        """
+        Refill the pool on a background thread
+        """
+
+        if self.refilling.locked():
+            return
+
+        thread = threading.Thread(target=self.refill, name='random-pool-refill', daemon=True)
+        thread.start()
+
+    def take(self):
+        """
+        Take a random document from the pool, or None if the pool is (still) empty
+        """
+
+        if not self.docs:
+            self.refill(wait=self.wait)
+
+        with self.lock:
+            doc = self.docs.pop() if self.docs else None
+            remaining = len(self.docs)
+            stale = time.time() - self.loaded > self.ttl
+
+        if remaining < self.low or stale:
+            self.refill_async()
+
+        return dict(doc) if doc else None
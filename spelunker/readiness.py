@@ -0,0 +1,103 @@
+# pylint: disable=broad-exception-caught,global-statement
+"""
+WoePlanet backend readiness: a cached, periodically refreshed, probe of Elasticsearch
+"""
+
+import logging
+import os
+import threading
+import time
+
+from spelunker import esclient
+
+logger = logging.getLogger('gunicorn.error')
+
+_probe = None
+
+
+class BackendProbe:
+    """
+    Checks that Elasticsearch is reachable and the indices are searchable, at most once every
+    `interval` seconds
+
+    Only the first check is made in the calling thread; after that a stale result is served while
+    a fresh one is fetched on a background thread, so readiness checks never wait on the backend.
+    """
+
+    def __init__(self, **kwargs):
+        self.indices = kwargs.get('indices', [])
+        self.interval = kwargs.get('interval', 10)
+        self.timeout = kwargs.get('timeout', 2)
+        self.esclient = kwargs.get('client', None)
+        self.result = None
+        self.checked = 0
+        self.probing = threading.Lock()
+
+    def probe(self):
+        """
+        Check the backend, now
+        """
+
+        if not self.probing.acquire(blocking=False):    # pylint: disable=consider-using-with
+            return
+
+        started = time.time()
+        try:
+            client = self.esclient if self.esclient else esclient.get_client()
+            rsp = client.cluster.health(index=','.join(self.indices), request_timeout=self.timeout)
+            status = rsp.get('status', 'red')
+            result = {
+                'ready': status in ('green', 'yellow'),
+                'backend': status
+            }
+
+        except Exception as exc:
+            logger.warning('Backend readiness probe failed: %s', exc)
+            result = {
+                'ready': False,
+                'backend': 'unreachable',
+                'error': str(exc)
+            }
+
+        finally:
+            self.probing.release()
+
+        result['checked'] = round(started, 3)
+        result['took_ms'] = round((time.time() - started) * 1000, 2)
+        self.result = result
+        self.checked = started
+
+    def status(self):
+        """
+        Get the latest probe result, refreshing it if it's stale
+        """
+
+        if self.result is None:
+            self.probe()
+
+        elif time.time() - self.checked > self.interval and not self.probing.locked():
+            thread = threading.Thread(target=self.probe, name='backend-probe', daemon=True)
+            thread.start()
+
+        result = self.result or {'ready': False, 'backend': 'unknown', 'checked': 0}
+        return dict(result, age=round(time.time() - result['checked'], 3) if result['checked'] else None)
+
+
+def backend_probe():
+    """
+    Get the backend probe for this process, creating it on first use
+    """
+
+    global _probe
+
+    if _probe is None:
+        _probe = BackendProbe(
+            indices=[
+                os.environ.get('WOE_ES_DOC_INDEX', 'woeplanet'),
+                os.environ.get('WOE_ES_PT_INDEX', 'placetypes')
+            ],
+            interval=int(os.environ.get('WOE_READY_INTERVAL', '10')),
+            timeout=int(os.environ.get('WOE_READY_TIMEOUT', '2'))
+        )
+
+    return _probe
@@ -0,0 +1,156 @@
+# pylint: disable=broad-exception-caught,global-statement
+"""
+WoePlanet index-derived static data snapshot
+
+The country and placetype facets for the whole index, and the placetype registry, only change when
+the index is rebuilt. They're built once, offline, with `flask --app spelunker.spelunker snapshot`,
+and loaded by each worker at boot.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger('gunicorn.error')
+
+SNAPSHOT_VERSION = 1
+
+_snapshot = None
+_snapshot_path = None
+
+
+class Snapshot:
+    """
+    A loaded snapshot, tagged with the generation of the index it was built from
+    """
+
+    def __init__(self, data, **kwargs):
+        self.data = data
+        self.path = kwargs.get('path', None)
+        self.stale = None
+
+    @property
+    def generation(self):
+        """
+        The generation of the index the snapshot was built from
+        """
+
+        return self.data.get('generation', None)
+
+    @property
+    def total(self):
+        """
+        The number of documents in the index
+        """
+
+        return self.data.get('total', 0)
+
+    @property
+    def countries(self):
+        """
+        The country facet buckets, with resolved country names
+        """
+
+        return self.data.get('countries', [])
+
+    @property
+    def placetypes(self):
+        """
+        The placetype facet buckets
+        """
+
+        return self.data.get('placetypes', [])
+
+    @property
+    def registry(self):
+        """
+        The placetype registry
+        """
+
+        return self.data.get('registry', [])
+
+    @property
+    def query(self):
+        """
+        The query the facets were built with
+        """
+
+        return self.data.get('query', {})
+
+    def current(self, generation):
+        """
+        Check whether the snapshot was built from the given index generation, logging once per
+        generation if it wasn't
+        """
+
+        if self.generation and self.generation == generation:
+            return True
+
+        if self.stale != generation:
+            logger.warning(
+                'Snapshot %s is for index generation %s, not %s; serving facets live', self.path, self.generation, generation
+            )
+            self.stale = generation
+
+        return False
+
+
+def load_snapshot(path):
+    """
+    Load a snapshot file, returning None if there isn't one or it can't be used
+    """
+
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'r', encoding='utf-8') as ifh:
+            data = json.load(ifh)
+
+    except Exception as exc:
+        logger.warning('Unable to load snapshot %s: %s', path, exc)
+        return None
+
+    if data.get('version', None) != SNAPSHOT_VERSION:
+        logger.warning('Ignoring snapshot %s: version %s, expected %s', path, data.get('version', None), SNAPSHOT_VERSION)
+        return None
+
+    logger.info('Loaded snapshot %s for index generation %s', path, data.get('generation', None))
+    return Snapshot(data, path=path)
+
+
+def write_snapshot(path, data):
+    """
+    Write a snapshot file, atomically, so a worker booting mid-write never sees half a snapshot
+    """
+
+    data = dict(data, version=SNAPSHOT_VERSION)
+    dirname = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirname, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as ofh:
+            json.dump(data, ofh, separators=(',', ':'))
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def get_snapshot():
+    """
+    Get the snapshot for this process, loading it on first use
+    """
+
+    global _snapshot, _snapshot_path
+
+    path = os.environ.get('WOE_SNAPSHOT_FILE', '')
+    if path != _snapshot_path:
+        _snapshot = load_snapshot(path)
+        _snapshot_path = path
+
+    return _snapshot
@@ -7,30 +7,83 @@ A simple Flask based spelunker for visualising, poking into and querying WoePlan
 # gunicorn spelunker.spelunker:app --bind $(hostname):8888 -w 2 --log-level debug
 
 import collections
+import functools
+import inspect
 import json
 import logging
 import os
 import random
 import re
+import threading
 import time
 import urllib
 
+import click
 import dotenv
 import flask
 import flask_caching
-import inflect
 import iso639
 import werkzeug.wrappers
 
 from woeplanet.utils import uri
 
+from spelunker import esclient, geometry, inflection, metrics, querybuilder
+from spelunker.fanout import fanout
+from spelunker.generation import index_generation
+from spelunker.placetypes import placetype_registry
 from spelunker.querymanager import QueryManager
+from spelunker.randompool import RandomPool
+from spelunker.readiness import backend_probe
+from spelunker.snapshot import get_snapshot, write_snapshot
 
 DEFAULT_SIDEBAR_WOEID = 44418
 DEFAULT_SIDEBAR_NAME = 'London'
 
 AGENTS = ['meta-externalagent', 'bytespider']
 
+STUB_INCLUDES = ['woe:id', 'woe:name', 'woe:placetype_name']
+CENTROID_INCLUDES = ['woe:centroid', 'geom:centroid']
+ALIAS_PROPERTY = re.compile(r'woe:alias_([A-Z]{3})_[A-Z]')
+GEOJSON_INCLUDES = ['woe:id', 'geometry', 'geom:bbox', 'geom:latitude', 'geom:longitude']
+SIDEBAR_INCLUDES = [
+    'woe:id',
+    'woe:name',
+    'woe:placetype',
+    'woe:placetype_name',
+    'woe:scale',
+    'woe:hierarchy',
+    'iso:country',
+    'woe:latitude',
+    'woe:longitude',
+    'woe:bbox',
+    'woe:centroid',
+    'geom:bbox',
+    'geom:centroid',
+    'geom:latitude',
+    'geom:longitude'
+]
+
+# Named _source profiles: the fields each kind of page actually uses. The first row of a listing is
+# also the page's sidebar place, so a listing needs the sidebar's fields; the place page shows the
+# map from the bounding box and centroid, so never needs the (often very large) geometry
+SOURCE_PROFILES = {
+    'stub': {
+        'includes': STUB_INCLUDES
+    },
+    'listing': {
+        'includes': SIDEBAR_INCLUDES
+    },
+    'sidebar': {
+        'includes': SIDEBAR_INCLUDES
+    },
+    'place-detail': {
+        'excludes': ['geometry']
+    },
+    'map': {
+        'includes': GEOJSON_INCLUDES
+    }
+}
+
 
 class BotBlockerMiddleware:  # pylint: disable=too-few-public-methods
     """
@@ -51,10 +104,52 @@ class BotBlockerMiddleware:  # pylint: disable=too-few-public-methods
         return self.app(environ, start_response)
 
 
+class RequestGlobals(flask.Flask.app_ctx_globals_class):
+    """
+    Per-request state (`flask.g`), with the resources in LAZY_GLOBALS created on first use
+
+    Each request gets its own instance, so the lock only guards against a request's own fan-out
+    threads creating a resource twice; it's reentrant as one factory may use another.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        factory = LAZY_GLOBALS.get(name, None)
+        if factory is None:
+            raise AttributeError(name)
+
+        with self.lock:
+            if name not in self.__dict__:
+                self.__dict__[name] = factory()
+
+            return self.__dict__[name]
+
+    def get(self, name, default=None):
+        if name in LAZY_GLOBALS:
+            return getattr(self, name)
+
+        return super().get(name, default)
+
+
+LAZY_GLOBALS = {
+    'docidx': lambda: os.environ.get('WOE_ES_DOC_INDEX', 'woeplanet'),
+    'ptidx': lambda: os.environ.get('WOE_ES_PT_INDEX', 'placetypes'),
+    'docmgr': lambda: QueryManager(index=flask.g.docidx, client=esclient.get_client()),
+    'ptmgr': lambda: QueryManager(index=flask.g.ptidx, client=esclient.get_client()),
+    'nearby_radius': lambda: '1km',
+    'track_total_hits': lambda: get_track_total_hits(),    # pylint: disable=unnecessary-lambda
+    'stubs': dict
+}
+
+
 dotenv.load_dotenv(dotenv.find_dotenv())
 template_dir = os.path.abspath('./templates')
 static_dir = os.path.abspath('./static')
 app = flask.Flask(__name__, template_folder=template_dir, static_folder=static_dir)
+app.app_ctx_globals_class = RequestGlobals
 app.wsgi_app = BotBlockerMiddleware(app.wsgi_app)
 
 if __name__ != '__main__':
@@ -64,9 +159,15 @@ if __name__ != '__main__':
 
 cache = flask_caching.Cache(
     config={
-        'CACHE_TYPE': 'FileSystemCache',
+        'CACHE_TYPE': 'spelunker.caching.LayeredCache',
         'CACHE_DEFAULT_TIMEOUT': 5,
         'CACHE_IGNORE_ERRORS': False,
+        'CACHE_SHARED_TYPE': os.environ.get('WOE_CACHE_BACKEND', 'filesystem'),
+        'CACHE_REDIS_URL': os.environ.get('WOE_CACHE_REDIS_URL'),
+        'CACHE_MEMCACHED_SERVERS': os.environ.get('WOE_CACHE_MEMCACHED_SERVERS', '127.0.0.1:11211').split(','),
+        'CACHE_LOCAL_SIZE': int(os.environ.get('WOE_CACHE_LOCAL_SIZE', '256')),
+        'CACHE_LOCAL_TIMEOUT': int(os.environ.get('WOE_CACHE_LOCAL_TIMEOUT', '5')),
+        'CACHE_STALE_TIMEOUT': int(os.environ.get('WOE_CACHE_STALE_TIMEOUT', '30')),
         'CACHE_DIR': os.environ.get('WOE_CACHE_DIR'),
         'CACHE_THRESHOLD': 500,
         'CACHE_OPTIONS': {
@@ -91,7 +192,7 @@ def anyfy(value):
     """
     Custom template filter: a vs. an
     """
-    return flask.g.inflect.an(value)
+    return inflection.an(value)
 
 
 @app.template_filter()
@@ -99,7 +200,7 @@ def pluralise(value, count):
     """
     Custom template filter: pluralise a value
     """
-    return flask.g.inflect.plural(value, count)
+    return inflection.plural(value, count)
 
 
 @app.errorhandler(404)
@@ -107,36 +208,19 @@ def page_not_found(error):
     """
     Error handler: 404
     """
-    params = {
-        'size': 1,
-        'random': True,
-        'include': {
-            'centroid': True
-        },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        }
-    }
-    _query, _params, rsp = do_search(**params)
-    if rsp['ok']:
-        args = {
-            'name': True
-        }
-        rows = inflatify(rsp['rows'], **args)
-
-        sidebar_woeid = int(rows[0].get('woe:id'))
-        sidebar_name = rows[0]['inflated'].get('name')
+    doc = random_doc()
+    if doc:
+        sidebar_woeid = int(doc.get('woe:id'))
+        sidebar_name = doc['inflated'].get('name')
 
         template_args = {
             'map': True,
             'title': f'404 Hic Sunt Dracones : {error.code} {error.name}',
             'woeid': sidebar_woeid,
             'name': sidebar_name,
-            'doc': rows[0]
+            'doc': doc
         }
-        template_args = get_geometry(rows[0], template_args)
+        template_args = get_geometry(doc, template_args)
         return flask.render_template('404.html.jinja', **template_args), 404
 
     return None, None
@@ -148,27 +232,10 @@ def internal_server_error(error):
     """
     Error handler: 5xx
     """
-    params = {
-        'size': 1,
-        'random': True,
-        'include': {
-            'centroid': True
-        },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        }
-    }
-    _query, _params, rsp = do_search(**params)
-    if rsp['ok']:
-        args = {
-            'name': True
-        }
-        rows = inflatify(rsp['rows'], **args)
-
-        sidebar_woeid = int(rows[0].get('woe:id'))
-        sidebar_name = rows[0]['inflated'].get('name')
+    doc = random_doc()
+    if doc:
+        sidebar_woeid = int(doc.get('woe:id'))
+        sidebar_name = doc['inflated'].get('name')
 
         template_args = {
             'map': True,
@@ -176,9 +243,9 @@ def internal_server_error(error):
             'error': error,
             'woeid': sidebar_woeid,
             'name': sidebar_name,
-            'doc': rows[0]
+            'doc': doc
         }
-        template_args = get_geometry(rows[0], template_args)
+        template_args = get_geometry(doc, template_args)
         return flask.render_template('500.html.jinja', **template_args), error.code
 
     return None, None
@@ -188,22 +255,44 @@ def internal_server_error(error):
 def init():
     """
     Initialisation/setup handler
+
+    Per-request state (the query managers, query parameters and so on) is set up lazily, on first
+    use, by RequestGlobals, so health checks, robots.txt and static files don't pay for it
+    """
+
+    metrics.begin()
+
+
+@app.after_request
+def record_request_stats(response):
+    """
+    After request handler: report this request's backend and cache activity, as a Server-Timing
+    header and a structured log line
     """
 
-    es_host = os.environ.get('WOE_ES_HOST', 'localhost')
-    es_port = os.environ.get('WOE_ES_PORT', '9200')
-    es_docidx = os.environ.get('WOE_ES_DOC_INDEX', 'woeplanet')
-    es_ptidx = os.environ.get('WOE_ES_PT_INDEX', 'placetypes')
+    stats = metrics.finish(flask.request.endpoint, response.status_code)
+    if stats:
+        response.headers['Server-Timing'] = stats.server_timing()
+        if os.environ.get('WOE_REQUEST_LOG', 'true').lower() in ('1', 'true', 'yes'):
+            line = dict(
+                path=flask.request.full_path.rstrip('?'),
+                endpoint=flask.request.endpoint,
+                status=response.status_code,
+                **stats.as_dict()
+            )
+            flask.current_app.logger.info('request_stats %s', json.dumps(line, separators=(',', ':')))
 
-    flask.g.docidx = es_docidx
-    flask.g.ptidx = es_ptidx
-    flask.g.inflect = inflect.engine()
-    flask.g.inflect.defnoun('miscellaneous', 'miscellaneous')
-    flask.g.inflect.defnoun('county', 'counties')
-    flask.g.docmgr = QueryManager(host=es_host, port=es_port, index=es_docidx)
-    flask.g.ptmgr = QueryManager(host=es_host, port=es_port, index=es_ptidx)
-    flask.g.nearby_radius = '1km'
-    flask.g.queryparams = get_queryparams()
+    return response
+
+
+@app.teardown_request
+def release_cache_rebuilds(_exc):
+    """
+    Teardown request handler: let go of the page cache rebuild locks for any pages this request
+    didn't write back, such as a view that aborted with a 404 or raised
+    """
+
+    cache.cache.release_rebuilds()
 
 
 @app.route('/', methods=['GET'])
@@ -213,28 +302,9 @@ def home_page():
     Page handler: default landing page
     """
 
-    params = {
-        'size': 1,
-        'random': True,
-        'include': {
-            'centroid': True
-        },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        }
-    }
-
-    _query, _params, rsp = do_search(**params)
-
-    if rsp['ok']:
-        woeid = int(rsp['rows'][0]['woe:id'])
-        args = {
-            'name': True
-        }
-        rows = inflatify(rsp['rows'], **args)
-        doc = rows[0]
+    doc = random_doc()
+    if doc:
+        woeid = int(doc['woe:id'])
         template_args = {
             'map': True,
             'title': 'Home',
@@ -265,54 +335,55 @@ def health_check():
 
     return {
         'status': 200,
-        'message': 'OK'
+        'message': 'OK',
+        'esclient': esclient.pool_stats()
+    }
+
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """
+    Readiness check endpoint: whether the backend is reachable, from a cached, periodic, probe
+    """
+
+    status = backend_probe().status()
+    return status, 200 if status['ready'] else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus metrics endpoint, for every worker sharing the metrics directory
+    """
+
+    return flask.Response(metrics.metrics().render(metrics_gauges()), mimetype='text/plain; version=0.0.4')
+
+
+def metrics_gauges():
+    """
+    Get this worker's point in time gauges: its backend connection pool and random pool
+    """
+
+    pool = esclient.pool_stats()
+    return {
+        'spelunker_es_pool_requests': pool['requests'],
+        'spelunker_es_pool_connections': pool['connections'],
+        'spelunker_random_pool_size': len(random_pool.docs)
     }
 
 
+metrics.register_gauges(metrics_gauges)
+
+
 @app.route('/about/', methods=['GET'])
 def about_page():
     """
     Page handler: about page
     """
 
-    params = {
-        'size': 1,
-        'random': True,
-        'include': {
-            'centroid': True
-        },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        },
-        'source': {
-            'includes': [
-                'woe:latitude',
-                'woe:longitude',
-                'woe:min_latitude',
-                'woe:min_longitude',
-                'woe:max_latitude',
-                'woe:max_longitude',
-                'woe:name',
-                'woe:id',
-                'woe:hierarchy',
-                'iso:country',
-                'woe:bbox',
-                'woe:centroid',
-                'geom:bbox',
-                'geom:centroid'
-            ]
-        }
-    }
-    _query, _params, rsp = do_search(**params)
-    if rsp['ok']:
-        args = {
-            'name': True
-        }
-        rows = inflatify(rsp['rows'], **args)
-        name = rows[0]['inflated']['name']
-        doc = rows[0]
+    doc = random_doc()
+    if doc:
+        name = doc['inflated']['name']
 
         template_args = {
             'map': True,
@@ -336,34 +407,18 @@ def credits_page():
     Page handler: credits page
     """
 
-    params = {
-        'size': 1,
-        'random': True,
-        'include': {
-            'centroid': True
-        },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        }
-    }
-    _query, _params, rsp = do_search(**params)
-    if rsp['ok']:
-        args = {
-            'name': True
-        }
-        rows = inflatify(rsp['rows'], **args)
-        name = rows[0]['inflated']['name']
+    doc = random_doc()
+    if doc:
+        name = doc['inflated']['name']
 
         template_args = {
             'map': True,
             'title': 'Credits',
-            'woeid': rows[0]['woe:id'],
+            'woeid': doc['woe:id'],
             'name': name,
-            'doc': rows[0]
+            'doc': doc
         }
-        template_args = get_geometry(rows[0], template_args)
+        template_args = get_geometry(doc, template_args)
         return flask.render_template('credits.html.jinja', **template_args)
 
     return None, None
@@ -377,77 +432,55 @@ def countries_page():
     """
 
     includes, excludes = excludify()
-    params = {
-        'size': 0,
-        'exclude': excludes,
-        'facets': {
-            'countries': True
-        }
-    }
-    query, _params, rsp = do_search(**params)
-
-    if rsp['ok']:
-        totals = {
-            'docs': rsp['pagination']['total'],
-            'countries': len(rsp['facets']['countries']['buckets'])
-        }
-        buckets = rsp['facets']['countries']['buckets']
-        for idx, country in enumerate(buckets):
-            params = {
-                'iso': country['key'],
-                'include': {
-                    'placetypes': [12]
-                },
-                'exclude': excludes,
-                'source': {
-                    'includes': ['woe:name', 'iso:country']
-                }
-            }
-            _query, _params, rsp = do_search(**params)
-            if rsp['ok']:
-                if country['key'] == 'ZZ':
-                    buckets[idx]['name'] = 'Sorry, the world is a complicated place'
-                elif country['key'] == 'XS':
-                    buckets[idx]['name'] = 'Serbia'
-                else:
-                    buckets[idx]['name'] = rsp['rows'][0]['woe:name']
+    snapshot = current_snapshot(includes)
+    if snapshot:
+        query = snapshot.query
+        total = snapshot.total
+        buckets = snapshot.countries
+        took = 0.0
+        doc = random_doc()
 
+    else:
         params = {
-            'size': 1,
-            'random': True,
-            'include': {
-                'centroid': True
-            },
-            'exclude': {
-                'placetypes': [0, 11, 25],
-                'nullisland': True,
-                'deprecated': True
+            'size': 0,
+            'exclude': excludes,
+            'track_total_hits': True,
+            'facets': {
+                'countries': True,
+                'country_names': True
             }
         }
+        (query, _params, rsp), doc = fanout(lambda: do_search(**params), random_doc)
+        if not rsp['ok']:
+            return None, None
 
-        _query, _params, res = do_search(**params)
-        if res['ok']:
-            args = {
-                'name': True
-            }
-            woeid = int(res['rows'][0]['woe:id'])
-            rows = inflatify(res['rows'], **args)
-            name = rows[0]['inflated']['name']
+        total = rsp['pagination']['total']
+        buckets = name_countries(rsp['facets']['countries']['buckets'])
+        took = rsp['took_sec']
 
-            template_args = {
-                'map': True,
-                'title': 'Countries',
-                'total': totals,
-                'buckets': buckets,
-                'doc': rows[0],
-                'woeid': woeid,
-                'name': name,
-                'es_query': trim_query(query),
-                'includes': includes if includes else None,
-                'took': rsp['took_sec']
-            }
-            template_args = get_geometry(rows[0], template_args)
-            return flask.render_template('countries.html.jinja', **template_args)
+    totals = {
+        'docs': total,
+        'countries': len(buckets)
+    }
+
+    if doc:
+        woeid = int(doc['woe:id'])
+        name = doc['inflated']['name']
+
+        template_args = {
+            'map': True,
+            'title': 'Countries',
+            'total': totals,
+            'buckets': buckets,
+            'doc': doc,
+            'woeid': woeid,
+            'name': name,
+            'es_query': trim_query(query),
+            'includes': includes if includes else None,
+            'took': took
+        }
+        template_args = get_geometry(doc, template_args)
+        return flask.render_template('countries.html.jinja', **template_args)
 
     return None, None
 
@@ -465,6 +498,7 @@ def country_page(iso):
 
     iso = iso.upper()
     params = {
+        'profile': 'listing',
         'iso': iso,
         'exclude': {
             'placetype': [0, 12],
@@ -499,28 +533,11 @@ def country_page(iso):
 
     else:
         rows = []
-        params = {
-            'size': 1,
-            'random': True,
-            'include': {
-                'centroid': True
-            },
-            'exclude': {
-                'placetypes': [0, 11, 25],
-                'nullisland': True,
-                'deprecated': True
-            }
-        }
-
-        _query, _params, res = do_search(**params)
-        if res['ok']:
-            args = {
-                'name': True
-            }
-            sidebar_woeid = int(res['rows'][0]['woe:id'])
-            rows = inflatify(res['rows'], **args)
-            sidebar_name = rows[0]['inflated']['name']
-            doc = rows[0]
+        row = random_doc()
+        if row:
+            sidebar_woeid = int(row['woe:id'])
+            sidebar_name = row['inflated']['name']
+            doc = row
 
     template_args = {
         'map': True,
@@ -544,19 +561,11 @@ def place_page(woeid):
     Page handler: place by WOEID page
     """
 
-    _query, doc = get_by_id(woeid)
+    doc = get_place(woeid)
     if not doc:
         flask.abort(404)
 
     _query, placetype = get_pt_by_id(doc['woe:placetype'])
-    args = {
-        'name': True,
-        'hierarchy': True,
-        'adjacencies': True,
-        'aliases': True,
-        'children': True
-    }
-    doc = inflatify(doc, **args)
 
     template_args = {
         'map': True,
@@ -578,21 +587,12 @@ def place_map_page(woeid):
     Page handler: map by WOEID page
     """
 
-    _query, doc = get_by_id(woeid)
+    doc = get_place(woeid)
     if not doc:
         flask.abort(404)
 
     _query, placetype = get_pt_by_id(doc['woe:placetype'])
 
-    args = {
-        'name': True,
-        'hierarchy': True,
-        'adjacencies': True,
-        'aliases': True,
-        'children': True
-    }
-    doc = inflatify(doc, **args)
-
     url = flask.url_for('place_page', woeid=woeid)
     name = doc['woe:name']
     popup = f'<h2>This is <a href="{url}">{name}</a></h2>'
@@ -606,11 +606,45 @@ def place_map_page(woeid):
         'placetype': placetype,
         'doc': doc,
         'popup': popup,
+        'geometry': True
     }
     template_args = get_geometry(doc, template_args)
     return flask.render_template('map.html.jinja', **template_args)
 
 
+@app.route('/id/<int:woeid>/geometry.json', methods=['GET'])
+def place_geometry(woeid):
+    """
+    Geometry handler: a place's geometry, simplified for a map zoom, as a GeoJSON Feature
+    """
+
+    try:
+        zoom = get_int('zoom')
+    except ValueError as _exc:    # noqa: F841
+        return api_error(400, 'zoom must be an integer')
+
+    zoom = get_single(zoom)
+    level = geometry.zoom_level(zoom)
+
+    generation = index_generation(flask.g.docidx)
+    status, data = get_place_geometry(woeid, level, generation)
+    if status == 404:
+        return api_error(404, f'WOEID {woeid} not found')
+
+    if status == 503:
+        return api_error(503, f'Unable to get WOEID {woeid}')
+
+    if status == 202:
+        body, status = api_error(202, f'Geometry for WOEID {woeid} is being built')
+        return body, status, {'Retry-After': '2', 'Cache-Control': 'no-store'}
+
+    rsp = flask.Response(data, mimetype='application/geo+json')
+    rsp.cache_control.public = True
+    rsp.cache_control.max_age = int(os.environ.get('WOE_GEOMETRY_MAX_AGE', '86400'))
+    rsp.set_etag(f'{generation}-{woeid}-{level}')
+    return rsp.make_conditional(flask.request)
+
+
 @app.route('/id/<int:woeid>/nearby/', methods=['GET'])
 @cache.cached(timeout=60, query_string=True)
 def nearby_id_page(woeid):
@@ -622,14 +656,10 @@ def nearby_id_page(woeid):
     sidebar_name = DEFAULT_SIDEBAR_NAME
     doc = {}
 
-    _query, doc = get_by_id(woeid)
+    doc = get_place(woeid)
     if not doc:
         flask.abort(404)
 
-    args = {
-        'name': True
-    }
-    doc = inflatify(doc, **args)
     nearby_name = doc['inflated']['name']
     nearby_id = woeid
 
@@ -645,15 +675,12 @@ def nearby_id_page(woeid):
         coords = doc['geom:centroid']
 
     params = {
+        'profile': 'listing',
         'nearby': {
             'radius': radius,
             'coordinates': coords
         },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        },
+        'exclude': querybuilder.EXCLUDE_PLACES,
         'facets': {
             'placetypes': True,
             'countries': False
@@ -684,27 +711,9 @@ def nearby_id_page(woeid):
 
     else:
         rows = []
-        params = {
-            'size': 1,
-            'random': True,
-            'include': {
-                'centroid': True
-            },
-            'exclude': {
-                'placetypes': [0, 11, 25],
-                'nullisland': True,
-                'deprecated': True
-            }
-        }
-
-        _query, _params, res = do_search(**params)
-        res = flask.g.docmgr.single_rsp(res, **params)
-        if res['ok']:
-            args = {
-                'name': True
-            }
-            sidebar_woeid = int(res['row']['woe:id'])
-            row = inflatify(res['row'], **args)
+        row = random_doc()
+        if row:
+            sidebar_woeid = int(row['woe:id'])
             sidebar_name = row['inflated']['name']
             doc = row
 
@@ -726,6 +735,65 @@ def nearby_id_page(woeid):
     return flask.render_template('results.html.jinja', **template_args)
 
 
+@app.route('/id/<int:woeid>/children/', methods=['GET'])
+@cache.cached(timeout=60, query_string=True)
+def children_page(woeid):
+    """
+    Child places page handler
+    """
+
+    doc = get_place(woeid)
+    if not doc:
+        flask.abort(404)
+
+    parent_name = doc['inflated']['name']
+    source = doc.get('woe:children', {})
+
+    placetype_name = get_str('placetype')
+    placetype_name = get_single(placetype_name)
+    if placetype_name:
+        source = {key: woeids for key, woeids in source.items() if key.lower() == placetype_name.lower()}
+
+    ids = [woeid for woeids in source.values() for woeid in woeids]
+    if not ids:
+        flask.abort(404)
+
+    params = {
+        'profile': 'listing',
+        'ids': ids,
+        'facets': {
+            'placetypes': True
+        }
+    }
+    query, _params, rsp = do_search(**params)
+    if not rsp['ok']:
+        flask.abort(404)
+
+    args = {
+        'name': True
+    }
+    rows = inflatify(rsp['rows'], **args)
+    if not rows:
+        flask.abort(404)
+
+    template_args = {
+        'map': True,
+        'title': f'Child places of {parent_name}',
+        'children_name': parent_name,
+        'children_id': woeid,
+        'results': rows,
+        'woeid': int(rows[0]['woe:id']),
+        'name': rows[0]['inflated']['name'],
+        'doc': rows[0],
+        'pagination': build_pagination_urls(pagination=rsp['pagination']),
+        'facets': rsp['facets'] if 'facets' in rsp else [],
+        'es_query': trim_query(query),
+        'took': rsp['took_sec']
+    }
+    template_args = get_geometry(rows[0], template_args)
+    return flask.render_template('results.html.jinja', **template_args)
+
+
 @app.route('/nearby/', methods=['GET'])
 @cache.cached(timeout=60, query_string=True)
 def nearby_page():
@@ -750,15 +818,12 @@ def nearby_page():
 
         coords = [lng, lat]
         params = {
+            'profile': 'listing',
             'nearby': {
                 'radius': radius,
                 'coordinates': coords
             },
-            'exclude': {
-                'placetypes': [0, 11, 25],
-                'nullisland': True,
-                'deprecated': True
-            },
+            'exclude': querybuilder.EXCLUDE_PLACES,
             'facets': {
                 'placetypes': True,
                 'countries': False
@@ -787,27 +852,9 @@ def nearby_page():
 
             else:
                 rows = []
-                params = {
-                    'size': 1,
-                    'random': True,
-                    'include': {
-                        'centroid': True
-                    },
-                    'exclude': {
-                        'placetypes': [0, 11, 25],
-                        'nullisland': True,
-                        'deprecated': True
-                    }
-                }
-
-                _query, _params, res = do_search(**params)
-                res = flask.g.docmgr.single_rsp(res, **params)
-                if res['ok']:
-                    args = {
-                        'name': True
-                    }
-                    sidebar_woeid = int(res['row']['woe:id'])
-                    row = inflatify(res['row'], **args)
+                row = random_doc()
+                if row:
+                    sidebar_woeid = int(row['woe:id'])
                     sidebar_name = row['inflated']['name']
                     doc = row
 
@@ -829,26 +876,9 @@ def nearby_page():
             template_args = get_geometry(doc, template_args)
             return flask.render_template('results.html.jinja', **template_args)
 
-    params = {
-        'size': 1,
-        'random': True,
-        'include': {
-            'centroid': True
-        },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        }
-    }
-
-    _query, _params, res = do_search(**params)
-    if res['ok']:
-        args = {
-            'name': True
-        }
-        sidebar_woeid = int(res['rows'][0]['woe:id'])
-        row = inflatify(res['rows'][0], **args)
+    row = random_doc()
+    if row:
+        sidebar_woeid = int(row['woe:id'])
         sidebar_name = row['inflated']['name']
         doc = row
 
@@ -858,12 +888,9 @@ def nearby_page():
         'nearby_lat': lat,
         'nearby_lng': lng,
         'nearby_id': sidebar_woeid,
-        'results': row,
         'woeid': sidebar_woeid,
         'name': sidebar_name,
-        'doc': doc,
-        'pagination': build_pagination_urls(pagination=res['pagination']),
-        'facets': res['facets'] if 'facets' in res else []
+        'doc': doc
     }
     template_args = get_geometry(doc, template_args)
     return flask.render_template('nearby.html.jinja', **template_args)
@@ -877,6 +904,7 @@ def nullisland_page():
     """
 
     params = {
+        'profile': 'listing',
         'include': {
             'nullisland': True
         },
@@ -927,60 +955,55 @@ def placetypes_page():
     """
 
     includes, excludes = excludify()
-    params = {
-        'size': 0,
-        'exclude': excludes,
-        'facets': {
-            'placetypes': True
+    snapshot = current_snapshot(includes)
+    if snapshot:
+        query = snapshot.query
+        total = snapshot.total
+        buckets = snapshot.placetypes
+        took = 0.0
+        doc = random_doc()
+
+    else:
+        params = {
+            'size': 0,
+            'exclude': excludes,
+            'track_total_hits': True,
+            'facets': {
+                'placetypes': True
+            }
         }
-    }
-    query, _params, rsp = do_search(**params)
-    if not rsp['ok']:
-        flask.abort(404)
+        (query, _params, rsp), doc = fanout(lambda: do_search(**params), random_doc)
+        if not rsp['ok']:
+            flask.abort(404)
 
-    totals = {
-        'docs': rsp['pagination']['total'],
-        'placetypes': len(rsp['facets']['placetypes']['buckets'])
-    }
-    buckets = rsp['facets']['placetypes']['buckets']
+        total = rsp['pagination']['total']
+        buckets = rsp['facets']['placetypes']['buckets']
+        took = rsp['took_sec']
 
-    params = {
-        'size': 1,
-        'random': True,
-        'include': {
-            'centroid': True
-        },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        }
+    totals = {
+        'docs': total,
+        'placetypes': len(buckets)
     }
 
-    _query, _params, res = do_search(**params)
-    if not rsp['ok']:
+    if not doc:
         flask.abort(404)
 
-    args = {
-        'name': True
-    }
-    woeid = int(res['rows'][0]['woe:id'])
-    rows = inflatify(res['rows'], **args)
-    name = rows[0]['inflated']['name']
+    woeid = int(doc['woe:id'])
+    name = doc['inflated']['name']
 
     template_args = {
         'map': True,
         'title': 'Placetypes',
         'total': totals,
         'buckets': buckets,
-        'doc': rows[0],
+        'doc': doc,
         'woeid': woeid,
         'name': name,
         'es_query': trim_query(query),
         'includes': includes if includes else None,
-        'took': rsp['took_sec']
+        'took': took
     }
-    template_args = get_geometry(rows[0], template_args)
+    template_args = get_geometry(doc, template_args)
     return flask.render_template('placetypes.html.jinja', **template_args)
 
 
@@ -1002,6 +1025,7 @@ def placetype_page(placetype_name):
     ptid = placetype['id']
     includes, excludes = excludify()
     params = {
+        'profile': 'listing',
         'include': {
             'placetypes': [ptid]
         },
@@ -1047,26 +1071,11 @@ def random_page():
     Random WOEID page handler
     """
 
-    params = {
-        'size': 1,
-        'random': True,
-        'search': {},
-        'include': {},
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
-        },
-        'facets': {
-            'placetypes': False,
-            'countries': False
-        }
-    }
-    _query, _params, rsp = do_search(**params)
-    if not rsp['ok']:
+    doc = random_doc()
+    if not doc:
         flask.abort(404)
 
-    woeid = int(rsp['rows'][0]['woe:id'])
+    woeid = int(doc['woe:id'])
     loc = flask.url_for('place_page', woeid=woeid)
     return flask.redirect(loc, code=303)
 
@@ -1086,23 +1095,12 @@ def search_page():
     q = get_single(q)
 
     if q:
-        if re.match(r'^\d+$', q):
-            woeid = int(q)
-            _query, doc = get_by_id(woeid)
-
-            if doc:
-                loc = flask.url_for('place_page', woeid=woeid)
-                return flask.redirect(loc, code=303)
-
         params = {
+            'profile': 'listing',
             'search': {
                 'names_all': q
             },
-            'exclude': {
-                'placetypes': [0],
-                'nullisland': True,
-                'deprecated': True
-            },
+            'exclude': querybuilder.EXCLUDE_DEFAULT,
             'facets': {
                 'placetypes': True,
                 'countries': False
@@ -1117,7 +1115,18 @@ def search_page():
                     'placetypes': [int(placetype['id'])]
                 }
 
-        query, _params, rsp = do_search(**params)
+        # A numeric query may be a WOEID; look it up in the same round trip as the name search
+        searches = [search_request(**params)]
+        if re.match(r'^\d+$', q):
+            searches.append({'body': ids_query([int(q)], includes=['woe:id'])})
+
+        responses = flask.g.docmgr.msearch(searches)
+        if len(searches) > 1 and 'hits' in responses[1] and flask.g.docmgr.single(responses[1]):
+            loc = flask.url_for('place_page', woeid=int(q))
+            return flask.redirect(loc, code=303)
+
+        query = searches[0]['body']
+        rsp = flask.g.docmgr.standard_rsp(responses[0], **searches[0]['params'])
         if rsp['ok']:
             if rsp['pagination']['total'] > 0 and rsp['pagination']['count'] > 0:
                 sidebar_woeid = int(rsp['rows'][0]['woe:id'])
@@ -1130,29 +1139,11 @@ def search_page():
 
             else:
                 rows = []
-                params = {
-                    'size': 1,
-                    'random': True,
-                    'include': {
-                        'centroid': True
-                    },
-                    'exclude': {
-                        'placetypes': [0, 11, 25],
-                        'nullisland': True,
-                        'deprecated': True
-                    }
-                }
-
-                _query, _params, res = do_search(**params)
-                if res['ok']:
-                    args = {
-                        'name': True
-                    }
-                    sidebar_woeid = int(res['rows'][0]['woe:id'])
-                    rows = inflatify(res['rows'], **args)
-                    sidebar_name = rows[0]['inflated']['name']
-                    doc = rows[0]
-                    rows = []
+                row = random_doc()
+                if row:
+                    sidebar_woeid = int(row['woe:id'])
+                    sidebar_name = row['inflated']['name']
+                    doc = row
 
             template_args = {
                 'map': True,
@@ -1170,39 +1161,489 @@ def search_page():
             template_args = get_geometry(doc, template_args)
             return flask.render_template('results.html.jinja', **template_args)
 
-    params = {
-        'size': 1,
-        'random': True,
-        'include': {
-            'centroid': True
-        },
-        'exclude': {
-            'placetypes': [0, 11, 25],
-            'nullisland': True,
-            'deprecated': True
+    doc = random_doc()
+    if doc:
+        sidebar_woeid = int(doc['woe:id'])
+        sidebar_name = doc['inflated']['name']
+
+        template_args = {
+            'map': True,
+            'title': 'Search',
+            'woeid': sidebar_woeid,
+            'name': sidebar_name,
+            'doc': doc
+        }
+        template_args = get_geometry(doc, template_args)
+        return flask.render_template('search.html.jinja', **template_args)
+
+    return {}, None
+
+
+@app.route('/api/id/<int:woeid>', methods=['GET'])
+def api_place(woeid):
+    """
+    API handler: place by WOEID, as a GeoJSON FeatureCollection
+    """
+
+    try:
+        terse, source, _limit = get_api_params()
+    except ValueError as exc:
+        return api_error(400, str(exc))
+
+    args = {}
+    if source:
+        args['includes'] = source
+
+    _query, doc, ok = find_by_id(woeid, **args)
+    if not ok:
+        return api_error(503, f'Unable to get WOEID {woeid}')
+    if not doc:
+        return api_error(404, f'WOEID {woeid} not found')
+
+    return flask.Response(
+        stream_geojson([doc], terse=terse),
+        mimetype='application/geo+json'
+    )
+
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """
+    API handler: search by name, as a streamed GeoJSON FeatureCollection
+    """
+
+    q = get_str('q')
+    q = get_single(q)
+    if not q:
+        return api_error(400, 'Missing q parameter')
+
+    params = {
+        'search': {
+            'names_all': q
+        },
+        'exclude': querybuilder.EXCLUDE_DEFAULT
+    }
+    return api_scan(params)
+
+
+@app.route('/api/nearby', methods=['GET'])
+def api_nearby():
+    """
+    API handler: places near a coordinate or a WOEID, as a streamed GeoJSON FeatureCollection
+    """
+
+    try:
+        lat = get_api_number('lat', sanitize_float)
+        lng = get_api_number('lng', sanitize_float)
+        woeid = get_api_number('woeid', sanitize_int)
+        radius = get_api_number('radius', sanitize_float)
+    except ValueError as exc:
+        return api_error(400, str(exc))
+
+    if woeid:
+        args = {
+            'includes': CENTROID_INCLUDES
+        }
+        _query, doc, ok = find_by_id(woeid, **args)
+        if not ok:
+            return api_error(503, f'Unable to get WOEID {woeid}')
+        if not doc:
+            return api_error(404, f'WOEID {woeid} not found')
+
+        coords = doc.get('woe:centroid', doc.get('geom:centroid', [0, 0]))
+
+    elif lat is not None and lng is not None:
+        coords = [lng, lat]
+
+    else:
+        return api_error(400, 'Missing lat and lng, or woeid, parameters')
+
+    return api_scan(api_nearby_params(coords, radius))
+
+
+def api_nearby_params(coords, radius=None):
+    """
+    Build the search parameters for the places near a coordinate
+    """
+
+    if not radius:
+        radius = flask.g.nearby_radius
+
+    return {
+        'nearby': {
+            'radius': radius,
+            'coordinates': coords
+        },
+        'exclude': querybuilder.EXCLUDE_PLACES
+    }
+
+
+@app.route('/api/placetype/<string:placetype_name>', methods=['GET'])
+def api_placetype(placetype_name):
+    """
+    API handler: places by placetype, as a streamed GeoJSON FeatureCollection
+    """
+
+    _query, placetype = get_pt_by_name(placetype_name)
+    if not placetype:
+        return api_error(404, f'Placetype {placetype_name} not found')
+
+    _includes, excludes = excludify()
+    params = {
+        'include': {
+            'placetypes': [placetype['id']]
+        },
+        'exclude': excludes
+    }
+
+    iso = get_str('iso')
+    iso = get_single(iso)
+    if iso:
+        params['iso'] = iso
+
+    return api_scan(params)
+
+
+@app.cli.command('snapshot')
+@click.option(
+    '--output',
+    default=lambda: os.environ.get('WOE_SNAPSHOT_FILE', './data-stores/spelunker/snapshot.json'),
+    help='Snapshot file to write'
+)
+def snapshot_command(output):
+    """
+    Snapshot the index wide country and placetype facets, and the placetype registry, for workers
+    to load at boot
+    """
+
+    with app.test_request_context('/'):
+        app.preprocess_request()
+
+        _includes, excludes = excludify()
+        params = {
+            'size': 0,
+            'exclude': excludes,
+            'track_total_hits': True,
+            'facets': {
+                'countries': True,
+                'country_names': True,
+                'placetypes': True
+            }
+        }
+        query, _params, rsp = do_search(**params)
+        if not rsp['ok']:
+            raise click.ClickException(f'Unable to facet the {flask.g.docidx} index: {rsp}')
+
+        registry = placetype_registry()
+        registry.load()
+        if registry.source != flask.g.ptidx:
+            raise click.ClickException(f'Unable to load the placetype registry from the {flask.g.ptidx} index')
+
+        countries = name_countries(rsp['facets']['countries']['buckets'])
+        for bucket in countries:
+            bucket.pop('country', None)
+
+        generation = index_generation(flask.g.docidx, refresh=0)
+        if generation == 'unknown':
+            raise click.ClickException(f'Unable to get the generation of the {flask.g.docidx} index')
+
+        data = {
+            'generation': generation,
+            'index': flask.g.docidx,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'query': query,
+            'total': rsp['pagination']['total'],
+            'countries': countries,
+            'placetypes': rsp['facets']['placetypes']['buckets'],
+            'registry': sorted(registry.ids.values(), key=lambda placetype: int(placetype['id']))
+        }
+
+    write_snapshot(output, data)
+    click.echo(
+        f"Wrote {output}: {len(data['countries'])} countries, {len(data['placetypes'])} placetypes, "
+        f"{len(data['registry'])} registry entries for index generation {data['generation']}"
+    )
+
+
+@app.cli.command('geometry')
+@click.option('--woeid', type=int, multiple=True, help='WOEID to precompute; may be repeated')
+@click.option('--placetype', multiple=True, help='Placetype to precompute every place of; may be repeated')
+@click.option('--limit', type=int, default=None, help='Maximum number of places to precompute')
+@click.option('--prune/--no-prune', default=True, help='Remove the cached geometry for other index generations')
+def geometry_command(woeid, placetype, limit, prune):
+    """
+    Precompute the simplified geometry levels for places, so maps never wait on simplifying the
+    largest polygons, and remove the geometry cached for any other index generation
+    """
+
+    with app.test_request_context('/'):
+        app.preprocess_request()
+
+        generation = index_generation(flask.g.docidx, refresh=0)
+        if generation == 'unknown':
+            raise click.ClickException(f'Unable to get the generation of the {flask.g.docidx} index')
+
+        placetypes = []
+        for name in placetype:
+            _query, entry = get_pt_by_name(name)
+            if not entry:
+                raise click.ClickException(f'Unknown placetype {name}')
+            placetypes.append(int(entry['id']))
+
+        query = {
+            'bool': {
+                'filter': [
+                    {'exists': {'field': 'geometry'}}
+                ]
+            }
+        }
+        if woeid:
+            query['bool']['filter'].append({'ids': {'values': list(woeid)}})
+        if placetypes:
+            query['bool']['filter'].append(querybuilder.placetype_filter(placetypes, 'include'))
+
+        body = {
+            'query': query,
+            '_source': source_profile('map')
+        }
+
+        store = geometry.geometry_cache()
+        count = 0
+        for doc in flask.g.docmgr.scan(body=body, limit=limit):
+            store.write(generation, doc['woe:id'], geometry.features(doc))
+            count += 1
+
+    click.echo(f'Wrote {count} places\' geometry to {store.root} for index generation {generation}')
+
+    if prune:
+        for removed in store.prune(generation):
+            click.echo(f'Removed the geometry for index generation {removed}')
+
+
+def api_scan(params):
+    """
+    Scroll through the results of a search, streaming them as a GeoJSON FeatureCollection
+    """
+
+    try:
+        terse, source, limit = get_api_params()
+    except ValueError as exc:
+        return api_error(400, str(exc))
+
+    placetype_name = get_str('placetype')
+    placetype_name = get_single(placetype_name)
+    if placetype_name:
+        _query, placetype = get_pt_by_name(placetype_name)
+        if not placetype:
+            return api_error(404, f'Placetype {placetype_name} not found')
+
+        params.setdefault('include', {})['placetypes'] = [int(placetype['id'])]
+
+    if source:
+        params['source'] = {
+            'includes': source
+        }
+
+    body = search_query(**params)
+    docs = flask.g.docmgr.scan(body=body, limit=limit)
+    if inspect.isasyncgen(docs):
+        features = astream_geojson(docs, terse=terse)
+    else:
+        features = flask.stream_with_context(stream_geojson(docs, terse=terse))
+
+    return flask.Response(features, mimetype='application/geo+json')
+
+
+def get_api_number(key, sanitize):
+    """
+    Get a single numeric API parameter, or None if it's missing or empty, raising ValueError with a
+    message for the client if it isn't a number
+    """
+
+    try:
+        value = get_single(get_param(key, sanitize))
+    except ValueError as _exc:    # noqa: F841
+        raise ValueError(f'{key} must be a number') from None
+
+    return None if value == '' else value
+
+
+def api_error(status, message):
+    """
+    Format an API error response
+    """
+
+    return {
+        'status': status,
+        'message': message
+    }, status
+
+
+def get_api_params():
+    """
+    Get the API output selection parameters: terse, _source and limit, raising ValueError if the
+    limit isn't a number
+    """
+
+    terse = get_str('terse')
+    terse = get_single(terse)
+    terse = terse is not None and terse.lower() in ('', '1', 'true', 'yes')
+
+    source = []
+    for fields in get_str('_source') or []:
+        source.extend(field.strip() for field in fields.split(',') if field.strip())
+    if source:
+        source.extend(GEOJSON_INCLUDES)
+    elif terse:
+        source.extend(source_profile('map')['includes'])
+
+    limit = get_api_number('limit', sanitize_int)
+    max_limit = int(os.environ.get('WOE_API_MAX_LIMIT', '100000'))
+    if not limit or limit < 0:
+        limit = int(os.environ.get('WOE_API_LIMIT', '1000'))
+    limit = min(limit, max_limit)
+
+    return terse, list(dict.fromkeys(source)), limit
+
+
+def stream_geojson(docs, terse=True):
+    """
+    Stream WoePlanet Elasticsearch documents as a GeoJSON FeatureCollection, one Feature at a time
+    """
+
+    yield '{"type":"FeatureCollection","features":['
+    for idx, doc in enumerate(docs):
+        feature = json.dumps(doc_to_geojson(doc, terse), separators=(',', ':'))
+        yield f',{feature}' if idx else feature
+    yield ']}'
+
+
+async def astream_geojson(docs, terse=True):
+    """
+    Stream WoePlanet Elasticsearch documents from an async scan as a GeoJSON FeatureCollection
+    """
+
+    yield '{"type":"FeatureCollection","features":['
+    idx = 0
+    async for doc in docs:
+        feature = json.dumps(doc_to_geojson(doc, terse), separators=(',', ':'))
+        yield f',{feature}' if idx else feature
+        idx += 1
+    yield ']}'
+
+
+def load_random_docs(size):
+    """
+    Load a batch of random, inflated, documents for the random place pool
+    """
+
+    with app.app_context():
+        flask.g.docmgr = QueryManager(index=os.environ.get('WOE_ES_DOC_INDEX', 'woeplanet'), client=esclient.get_client())
+        flask.g.stubs = {}
+
+        params = {
+            'size': size,
+            'random': True,
+            'track_total_hits': False,
+            'include': {
+                'centroid': True
+            },
+            'exclude': querybuilder.EXCLUDE_PLACES,
+            'profile': 'sidebar'
         }
-    }
+        body = search_query(**params)
+        rsp = flask.g.docmgr.query(body=body)
+        if 'hits' not in rsp:
+            flask.current_app.logger.error(rsp.get('error', rsp))
+            return []
 
-    _query, _params, rsp = do_search(**params)
-    if rsp['ok']:
         args = {
             'name': True
         }
-        sidebar_woeid = int(rsp['rows'][0]['woe:id'])
-        rows = inflatify(rsp['rows'], **args)
-        sidebar_name = rows[0]['inflated']['name']
+        return inflatify(flask.g.docmgr.rows(rsp), **args)
 
-        template_args = {
-            'map': True,
-            'title': 'Search',
-            'woeid': sidebar_woeid,
-            'name': sidebar_name,
-            'doc': rows[0]
-        }
-        template_args = get_geometry(rows[0], template_args)
-        return flask.render_template('search.html.jinja', **template_args)
 
-    return {}, None
+random_pool = RandomPool(
+    loader=load_random_docs,
+    size=int(os.environ.get('WOE_RANDOM_POOL_SIZE', '2000')),
+    ttl=int(os.environ.get('WOE_RANDOM_POOL_TTL', '600'))
+)
+
+
+def random_doc():
+    """
+    Get a random, inflated, document from the random place pool
+    """
+
+    return random_pool.take()
+
+
+def get_place(woeid):
+    """
+    Get a fully inflated document by WOEID, via the place cache
+
+    Places are cached per index generation, so a cached place is only ever replaced when the index
+    is rebuilt (or the entry ages out); a WOEID that doesn't exist is cached (briefly) as False, but
+    nothing is cached if the backend couldn't be asked
+    """
+
+    generation = index_generation(flask.g.docidx)
+    key = f'place/{generation}/{woeid}'
+
+    doc = cache.get(key)
+    if doc is None:
+        _query, doc, ok = find_by_id(woeid, profile='place-detail')
+        if doc:
+            args = {
+                'name': True,
+                'hierarchy': True,
+                'adjacencies': True,
+                'aliases': True,
+                'children': True
+            }
+            doc = inflatify(doc, **args)
+            cache.set(key, doc, timeout=int(os.environ.get('WOE_PLACE_CACHE_TIMEOUT', '86400')))
+        elif ok:
+            cache.set(key, False, timeout=60)
+
+    return doc
+
+
+def get_place_geometry(woeid, level, generation):
+    """
+    Get a place's geometry, simplified for a zoom level, as a serialised GeoJSON Feature, with a
+    status: 200, 404 if there's no such place, 503 if the backend couldn't be asked, or 202 if
+    another request is building the place's levels and they aren't ready yet
+
+    Every level is simplified and cached on disk the first time any level of a place is asked for,
+    by one request at a time; after that a level is served straight from its file
+    """
+
+    store = geometry.geometry_cache()
+    data = store.read(generation, woeid, level)
+    if data is not None:
+        return 200, data
+
+    if not store.lock(generation, woeid):
+        data = store.wait_for(generation, woeid, level)
+        return (200, data) if data is not None else (202, None)
+
+    try:
+        # Another build may have finished between the read and taking the lock
+        data = store.read(generation, woeid, level)
+        if data is not None:
+            return 200, data
+
+        _query, doc, ok = find_by_id(woeid, profile='map')
+        if not doc:
+            return (404 if ok else 503), None
+
+        levels = geometry.features(doc)
+        store.write(generation, woeid, levels)
+        return 200, levels[level]
+
+    finally:
+        store.unlock(generation, woeid)
 
 
 def get_by_id(woeid, **kwargs):
@@ -1210,29 +1651,21 @@ def get_by_id(woeid, **kwargs):
     Get a document by WOEID
     """
 
-    includes = kwargs.get('includes', [])
-    excludes = kwargs.get('excludes', [])
+    body, doc, _ok = find_by_id(woeid, **kwargs)
+    return body, doc
 
-    query = {
-        'ids': {
-            'values': [woeid]
-        }
-    }
-    body = {
-        'query': query
-    }
 
-    if includes or excludes:
-        body['_source'] = {}
-        if includes:
-            body['_source']['includes'] = includes
-        if excludes:
-            body['_source']['excludes'] = excludes
+def find_by_id(woeid, **kwargs):
+    """
+    Get a document by WOEID, and whether the backend answered, so a WOEID that doesn't exist (no
+    document, ok) can be told apart from a failed backend request (no document, not ok)
+    """
 
+    body = ids_query([woeid], **kwargs)
     rsp = flask.g.docmgr.query(body=body)
 
     if 'hits' in rsp:
-        return body, flask.g.docmgr.single(rsp)
+        return body, flask.g.docmgr.single(rsp), True
 
     if 'error' in rsp:
         flask.current_app.logger.error(rsp['error'])
@@ -1240,7 +1673,7 @@ def get_by_id(woeid, **kwargs):
     else:
         flask.current_app.logger.error(rsp)
 
-    return {}, None
+    return {}, None, False
 
 
 def get_by_ids(*, ids, **kwargs):
@@ -1248,25 +1681,7 @@ def get_by_ids(*, ids, **kwargs):
     Get documents by multiple WOEIDs
     """
 
-    includes = kwargs.get('includes', [])
-    excludes = kwargs.get('excludes', [])
-
-    query = {
-        'ids': {
-            'values': ids
-        }
-    }
-    body = {
-        'query': query
-    }
-
-    if includes or excludes:
-        body['_source'] = {}
-        if includes:
-            body['_source']['includes'] = includes
-        if excludes:
-            body['_source']['excludes'] = excludes
-
+    body = ids_query(ids, **kwargs)
     rsp = flask.g.docmgr.query(body=body)
 
     if 'hits' in rsp:
@@ -1281,17 +1696,33 @@ def get_by_ids(*, ids, **kwargs):
     return None
 
 
-def get_pt_by_id(ptid, **kwargs):
+def source_profile(name):
     """
-    Get a placetype by id
+    Get a copy of a named _source profile, safe to put in (and modify as part of) a query, or an
+    empty profile, for the whole document, if there's no such profile
+    """
+
+    profile = SOURCE_PROFILES.get(name, None)
+    if profile is None:
+        if name:
+            flask.current_app.logger.warning('Unknown _source profile %s', name)
+        return {}
+
+    return {key: list(fields) for key, fields in profile.items()}
+
+
+def ids_query(ids, **kwargs):
+    """
+    Build the Elasticsearch query for documents by WOEID
     """
 
-    includes = kwargs.get('includes', [])
-    excludes = kwargs.get('excludes', [])
+    profile = source_profile(kwargs.get('profile', None))
+    includes = kwargs.get('includes', profile.get('includes', []))
+    excludes = kwargs.get('excludes', profile.get('excludes', []))
 
     query = {
         'ids': {
-            'values': [ptid]
+            'values': ids
         }
     }
     body = {
@@ -1305,58 +1736,81 @@ def get_pt_by_id(ptid, **kwargs):
         if excludes:
             body['_source']['excludes'] = excludes
 
-    rsp = flask.g.ptmgr.query(body=body)
+    return body
 
-    if 'hits' in rsp:
-        return body, flask.g.ptmgr.single(rsp)
 
-    if 'error' in rsp:
-        flask.current_app.logger.error(rsp['error'])
+def get_stubs(ids):
+    """
+    Get abbreviated documents for multiple WOEIDs, fetching each WOEID at most once per request
+    """
 
-    else:
-        flask.current_app.logger.error(rsp)
+    stubs = flask.g.stubs
+    missing = list(dict.fromkeys(int(woeid) for woeid in ids if int(woeid) not in stubs))
+    if missing:
+        rsp = flask.g.docmgr.mget(ids=missing, **source_profile('stub'))
+        if 'docs' in rsp:
+            for doc in flask.g.docmgr.found(rsp):
+                stubs[int(doc['woe:id'])] = doc
 
-    return {}, None
+        elif 'error' in rsp:
+            flask.current_app.logger.error(rsp['error'])
+
+        else:
+            flask.current_app.logger.error(rsp)
 
+        for woeid in missing:
+            stubs.setdefault(woeid, None)
 
-def get_pt_by_name(name, **kwargs):
+    return {int(woeid): stubs.get(int(woeid)) for woeid in ids}
+
+
+def get_pt_by_id(ptid):
+    """
+    Get a placetype by id
+    """
+
+    return {}, placetype_registry().by_id(ptid)
+
+
+def get_pt_by_name(name):
     """
     Get a placetype by name
     """
 
-    includes = kwargs.get('includes', [])
-    excludes = kwargs.get('excludes', [])
+    return {}, placetype_registry().by_name(name)
 
-    body = {
-        'query': {
-            'bool': {
-                'must': [{
-                    'match': {
-                        'shortname': name.lower()
-                    }
-                }]
-            }
-        }
-    }
 
-    body['_source'] = {}
-    if includes:
-        body['_source']['includes'] = includes
-    if excludes:
-        body['_source']['excludes'] = excludes
+def name_countries(buckets):
+    """
+    Resolve the names of the countries in a country facet, from each bucket's country document
+    """
+
+    for bucket in buckets:
+        if bucket['key'] == 'ZZ':
+            bucket['name'] = 'Sorry, the world is a complicated place'
+        elif bucket['key'] == 'XS':
+            bucket['name'] = 'Serbia'
+        else:
+            hits = bucket.get('country', {}).get('name', {}).get('hits', {}).get('hits', [])
+            bucket['name'] = hits[0]['_source']['woe:name'] if hits else bucket['key']
 
-    rsp = flask.g.ptmgr.query(body=body)
+    return buckets
 
-    if 'hits' in rsp:
-        return body, flask.g.ptmgr.single(rsp)
 
-    if 'error' in rsp:
-        flask.current_app.logger.error(rsp['error'])
+def current_snapshot(includes):
+    """
+    Get the static data snapshot, if there's one for the current generation of the documents index
+    and the request uses the default exclusions
+    """
 
-    else:
-        flask.current_app.logger.error(rsp)
+    snapshot = get_snapshot()
+    if includes or snapshot is None:
+        return None
 
-    return {}, None
+    if not snapshot.current(index_generation(flask.g.docidx)):
+        return None
+
+    return snapshot
 
 
 def get_language(code):
@@ -1364,11 +1818,48 @@ def get_language(code):
     Get language by ISO-639 code
     """
 
-    try:
-        lang = iso639.languages.get(part2b=code.lower())
-        return lang.name
-    except KeyError as _exc:    # noqa: F841
-        return 'Unknown'
+    return language_names().get(code.lower(), 'Unknown')
+
+
+@functools.lru_cache(maxsize=None)
+def language_names():
+    """
+    Get the ISO-639-2/B language names, by code, loaded once per process
+    """
+
+    return {code: lang.name for code, lang in iso639.languages.part2b.items()}
+
+
+@functools.lru_cache(maxsize=4096)
+def alias_language_code(prop):
+    """
+    Get the language code of a `woe:alias_<LANG>_<TYPE>` property, or None if it isn't one
+    """
+
+    match = ALIAS_PROPERTY.fullmatch(prop)
+    return match.group(1) if match else None
+
+
+def get_aliases(doc):
+    """
+    Get a document's aliases, grouped by language
+
+    If the document carries an index of its alias properties (`woe:alias_keys`) only those are
+    looked at, otherwise every property is checked
+    """
+
+    props = doc.get('woe:alias_keys', None) or doc.keys()
+
+    aliases = []
+    for prop in props:
+        code = alias_language_code(prop)
+        if code and prop in doc:
+            aliases.append({
+                'lang': 'Unknown' if code == 'UNK' else get_language(code),
+                'aliases': doc.get(prop)
+            })
+
+    return sorted(aliases, key=lambda k: k['lang'])
 
 
 def get_param(key, sanitize=None):
@@ -1478,11 +1969,7 @@ def excludify():
     """
 
     includes = listify(get_str('include'))
-    excludes = {
-        'placetypes': [0],
-        'nullisland': True,
-        'deprecated': True
-    }
+    excludes = dict(querybuilder.EXCLUDE_DEFAULT)
     if 'unknown' in includes:
         excludes.pop('placetypes')
     if 'nullisland' in includes:
@@ -1493,34 +1980,22 @@ def excludify():
     return includes, excludes
 
 
-def get_queryparams():
+def get_track_total_hits():
     """
-    Get all supported query parameters
+    Get the site wide default for counting search totals: true (exact), false (don't count) or a
+    cap, above which the total is reported as a lower bound
     """
 
-    params = {
-        'placetype': get_single(get_str('placetype')),
-        'page': get_single(get_int('page')),
-        'lat': get_single(get_float('lat')),
-        'lng': get_single(get_float('lng')),
-        'radius': get_single(get_float('radius')),
-        'q': get_single(get_str('q')),
-        'includes': listify(get_str('include')),
-        'excludes': {
-            'placetypes': [0],
-            'nullisland': True,
-            'deprecated': True
-        },
-        'view_args': flask.request.view_args
-    }
-    if 'unknown' in params['includes']:
-        params['excludes'].pop('placetypes')
-    if 'nullisland' in params['includes']:
-        params['excludes'].pop('nullisland')
-    if 'deprecated' in params['includes']:
-        params['excludes'].pop('deprecated')
+    value = os.environ.get('WOE_TRACK_TOTAL_HITS', '10000').strip().lower()
+    if value in ('true', 'yes'):
+        return True
+    if value in ('false', 'no', '0'):
+        return False
 
-    return params
+    try:
+        return int(value)
+    except ValueError as _exc:    # noqa: F841
+        return True
 
 
 def do_search(**kwargs):
@@ -1528,6 +2003,19 @@ def do_search(**kwargs):
     Search ... !
     """
 
+    search = search_request(**kwargs)
+    rsp = flask.g.docmgr.query(**search)
+    rsp = flask.g.docmgr.standard_rsp(rsp, **search['params'])
+
+    return search['body'], search['params'], rsp
+
+
+def search_request(**kwargs):
+    """
+    Build a search, with the request's pagination, as the keyword arguments for a QueryManager query
+    or one search in a multi-search
+    """
+
     params = kwargs
     body = search_query(**params)
 
@@ -1592,10 +2080,10 @@ def do_search(**kwargs):
     else:
         pass
 
-    rsp = flask.g.docmgr.query(body=body, params=params)
-    rsp = flask.g.docmgr.standard_rsp(rsp, **params)
-
-    return body, params, rsp
+    return {
+        'body': body,
+        'params': params
+    }
 
 
 def search_query(**kwargs):
@@ -1604,19 +2092,24 @@ def search_query(**kwargs):
     """
 
     size = kwargs.get('size', 10)
+    track_total_hits = kwargs.get('track_total_hits', flask.g.get('track_total_hits', True))
     search = kwargs.get('search',
                         {})
     country = kwargs.get('iso', None)
     nearby = kwargs.get('nearby',
                         {})
+    ids = kwargs.get('ids', [])
     randomify = kwargs.get('random', False)
     source = kwargs.get('source', None)
+    if not source:
+        source = source_profile(kwargs.get('profile', None))
     if not source:
         source = True
 
     query = {
         'bool': {
             'must': [],
+            'filter': [],
             'must_not': []
         }
     }
@@ -1652,12 +2145,12 @@ def search_query(**kwargs):
             }})
 
     elif country:
-        query['bool']['must'].append({'match': {
+        query['bool']['filter'].append({'match': {
             'iso:country': country.upper()
         }})
 
     elif nearby:
-        query['bool']['must'].append(
+        query['bool']['filter'].append(
             {
                 'geo_shape': {
                     'geometry': {
@@ -1671,10 +2164,15 @@ def search_query(**kwargs):
             }
         )
 
+    elif ids:
+        query['bool']['filter'].append({'ids': {
+            'values': ids
+        }})
+
     query = enfilter(query, **kwargs)
     body = {
         'size': size,
-        'track_total_hits': True,
+        'track_total_hits': track_total_hits,
         '_source': source
     }
 
@@ -1696,7 +2194,7 @@ def search_query(**kwargs):
         }
 
     elif query:
-        if query['bool']['must'] or query['bool']['must_not']:
+        if any(query['bool'].values()):
             body['query'] = query
 
     facets = enfacet(**kwargs)
@@ -1711,115 +2209,11 @@ def enfilter(query, **kwargs):
     Add filters to the search query
     """
 
-    includes = kwargs.get('include', {})
-    excludes = kwargs.get('exclude', {})
-
-    must = []
-    mustnot = []
-
-    if includes:
-        centroid = includes.get('centroid', False)
-        nullisland = includes.get('nullisland', False)
-
-        if centroid:
-            must.append({'exists': {
-                'field': 'woe:latitude'
-            }})
-            must.append({'exists': {
-                'field': 'woe:longitude'
-            }})
-
-        if nullisland:
-            must.append({'term': {
-                'geom:latitude': {
-                    'value': 0.0
-                }
-            }})
-            must.append({'term': {
-                'geom:longitude': {
-                    'value': 0.0
-                }
-            }})
-            mustnot.append({'term': {
-                'woe:id': {
-                    'value': 1
-                }
-            }})
-            mustnot.append({'exists': {
-                'field': 'woe:superseded_by'
-            }})
-
-        placetypes = includes.get('placetypes', [])
-        if placetypes:
-            ids = []
-            for place_type in placetypes:
-                _query, placetype = get_pt_by_id(place_type)
-                if not placetype:
-                    flask.current_app.logger.warning(
-                        'Invalid enfilter:include:placetype %s',
-                        place_type
-                    )
-                    flask.abort(404)
-
-                ids.append(place_type)
-
-            if len(ids) == 1:
-                must.append({'term': {
-                    'woe:placetype': ids[0]
-                }})
-            else:
-                must.append({'terms': {
-                    'woe:placetype': ids
-                }})
-
-    if excludes:
-        placetypes = excludes.get('placetypes', [])
-        nullisland = excludes.get('nullisland', False)
-        deprecated = excludes.get('deprecated', False)
-
-        if placetypes:
-            ids = []
-            for place_type in placetypes:
-                _query, placetype = get_pt_by_id(place_type)
-                if not placetype:
-                    flask.current_app.logger.warning(
-                        'Invalid enfilter:exclude:placetype %s',
-                        place_type
-                    )
-                    flask.abort(404)
-
-                ids.append(place_type)
-
-            if len(ids) == 1:
-                mustnot.append({'term': {
-                    'woe:placetype': ids[0]
-                }})
-            else:
-                mustnot.append({'terms': {
-                    'woe:placetype': ids
-                }})
-
-        if nullisland:
-            mustnot.append({'term': {
-                'geom:latitude': {
-                    'value': 0.0
-                }
-            }})
-            mustnot.append({'term': {
-                'geom:longitude': {
-                    'value': 0.0
-                }
-            }})
-
-        if deprecated:
-            mustnot.append({'exists': {
-                'field': 'woe:superseded_by'
-            }})
-
-    if must:
-        query['bool']['must'].extend(must)
-    if mustnot:
-        query['bool']['must_not'].extend(mustnot)
+    filters = querybuilder.compile_filters(kwargs.get('include', {}), kwargs.get('exclude', {}))
+    if filters.filter:
+        query['bool']['filter'].extend(filters.filter)
+    if filters.must_not:
+        query['bool']['must_not'].extend(filters.must_not)
 
     return query
 
@@ -1834,6 +2228,7 @@ def enfacet(**kwargs):
     if facets_param:
         placetypes = facets_param.get('placetypes', False)
         countries = facets_param.get('countries', False)
+        country_names = facets_param.get('country_names', False)
 
         if placetypes:
             facets['placetypes'] = {
@@ -1849,6 +2244,26 @@ def enfacet(**kwargs):
                     'size': 10000
                 }
             }
+            if country_names:
+                facets['countries']['aggs'] = {
+                    'country': {
+                        'filter': {
+                            'term': {
+                                'woe:placetype': 12
+                            }
+                        },
+                        'aggs': {
+                            'name': {
+                                'top_hits': {
+                                    'size': 1,
+                                    '_source': {
+                                        'includes': ['woe:name']
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
 
     return facets
 
@@ -1869,11 +2284,23 @@ def inflatify(docs, **kwargs):
     adjacencies = []
     aliases = []
     children = {}
+    more_children = {}
 
     if isinstance(docs, dict):
         single = True
         docs = [docs]
 
+    woeids = []
+    if inflate_name or inflate_hierarchy:
+        for doc in docs:
+            woeids.extend(woeid for woeid in doc.get('woe:hierarchy', {}).values() if woeid != 0)
+
+    ancestors, adjacent, descendants = fanout(
+        lambda: get_stubs(woeids) if woeids else {},
+        lambda: [get_adjacencies(doc) for doc in docs] if inflate_adjacencies else [],
+        lambda: [get_children(doc) for doc in docs] if inflate_children else []
+    )
+
     for idx, doc in enumerate(docs):
         if inflate_name and 'woe:name' in doc:
             name = doc.get('woe:name', None)
@@ -1883,15 +2310,11 @@ def inflatify(docs, **kwargs):
             hierarchy = {}
             try:
                 source = doc.get('woe:hierarchy', {})
-                if source:
-                    args = {
-                        'includes': ['woe:id', 'woe:name']
-                    }
-                    for placetype_name, woeid in source.items():
-                        if woeid != 0:
-                            _query, hdoc = get_by_id(woeid, **args)
-                            if doc:
-                                hierarchy[placetype_name] = hdoc
+                for placetype_name, woeid in source.items():
+                    if woeid != 0:
+                        hdoc = ancestors.get(int(woeid), None)
+                        if hdoc:
+                            hierarchy[placetype_name] = hdoc
 
             except Exception as exc:
                 flask.current_app.logger.error(
@@ -1912,71 +2335,98 @@ def inflatify(docs, **kwargs):
             name = ', '.join(labels)
 
         if inflate_adjacencies:
-            source = doc.get('woe:adjacent', [])
-            if source:
-                args = {
-                    'includes': ['woe:id', 'woe:placetype_name', 'woe:name']
-                }
-                adjs = {}
-                for woeid in source:
-                    _query, adoc = get_by_id(woeid, **args)
-                    if doc:
-                        pts = flask.g.inflect.plural(adoc['woe:placetype_name'])
-                        if pts not in adjs:
-                            adjs[pts] = [adoc]
-                        else:
-                            adjs[pts].append(adoc)
-
-                for placetype_name in adjs:
-                    adjs[placetype_name] = sorted(adjs[placetype_name], key=lambda k: k['woe:name'])
-
-                adjacencies = dict(collections.OrderedDict(sorted(adjs.items())))
+            adjacencies = adjacent[idx]
 
         if inflate_aliases:
-            for prop in doc:
-                match = re.fullmatch(r'^woe:alias_([A-Z]{3})_[A-Z]{1}$', prop)
-                if match:
-                    code = match.group(1)
-                    if code == 'UNK':
-                        language = 'Unknown'
-
-                    else:
-                        lang = iso639.languages.get(part2b=code.lower())
-                        language = lang.name
-
-                    aliases.append({
-                        'lang': language,
-                        'aliases': doc.get(prop)
-                    })
-
-            aliases = sorted(aliases, key=lambda k: k['lang'])
+            aliases = get_aliases(doc)
 
         if inflate_children:
-            source = doc.get('woe:children', {})
-            if source:
-                args = {
-                    'includes': ['woe:id', 'woe:name']
-                }
-                for placetype_name, ids in source.items():
-                    _query, placetype_name = get_pt_by_name(placetype_name)
-                    sdocs = get_by_ids(ids=ids, **args)
-                    if sdocs:
-                        pts = flask.g.inflect.plural(placetype_name['name'])
-                        children[pts] = sorted(sdocs, key=lambda k: k['woe:name'])
-
-                children = dict(collections.OrderedDict(sorted(children.items())))
+            children, more_children = descendants[idx]
 
         docs[idx]['inflated'] = {
             'name': name,
             'hierarchy': hierarchy,
             'adjacencies': adjacencies,
             'aliases': aliases,
-            'children': children
+            'children': children,
+            'more_children': more_children
         }
 
     return docs[0] if single else docs
 
 
+def get_adjacencies(doc):
+    """
+    Get a document's adjacent places, grouped by (pluralised) placetype
+    """
+
+    adjacencies = {}
+    source = doc.get('woe:adjacent', [])
+    if source:
+        stubs = get_stubs(source)
+        adjs = {}
+        for woeid in source:
+            adoc = stubs.get(int(woeid), None)
+            if adoc:
+                pts = placetype_label(adoc['woe:placetype_name'])
+                if pts not in adjs:
+                    adjs[pts] = [adoc]
+                else:
+                    adjs[pts].append(adoc)
+
+        for placetype_name in adjs:
+            adjs[placetype_name] = sorted(adjs[placetype_name], key=lambda k: k['woe:name'])
+
+        adjacencies = dict(collections.OrderedDict(sorted(adjs.items())))
+
+    return adjacencies
+
+
+def get_children(doc):
+    """
+    Get a document's child places, grouped by (pluralised) placetype and capped at `WOE_CHILDREN_LIMIT`
+    places per placetype
+
+    All children are fetched as stubs in a single request; groups that were capped are listed, with
+    their full size, in the document's `more_children`
+    """
+
+    children = {}
+    more = {}
+    source = doc.get('woe:children', {})
+    if source:
+        limit = int(os.environ.get('WOE_CHILDREN_LIMIT', '100'))
+        ids = [woeid for woeids in source.values() for woeid in woeids]
+        stubs = get_stubs(ids)
+
+        for placetype_name, woeids in source.items():
+            sdocs = [stubs[int(woeid)] for woeid in woeids if stubs.get(int(woeid), None)]
+            if not sdocs:
+                continue
+
+            _query, placetype = get_pt_by_name(placetype_name)
+            pts = placetype_label(placetype['name'] if placetype else placetype_name)
+            children[pts] = sorted(sdocs, key=lambda k: k['woe:name'])
+            if len(children[pts]) > limit:
+                children[pts] = children[pts][:limit]
+                more[pts] = {
+                    'placetype': placetype_name,
+                    'total': len(sdocs)
+                }
+
+        children = dict(collections.OrderedDict(sorted(children.items())))
+
+    return children, more
+
+
+def placetype_label(placetype_name):
+    """
+    Get the (memoised) pluralised label for a group of places of a placetype
+    """
+
+    return inflection.plural(placetype_name)
+
+
 def build_pagination_urls(*, pagination):
     """
     Build previous/next pagination URLs
@@ -1986,17 +2436,14 @@ def build_pagination_urls(*, pagination):
 
     pages = int(pagination['pages'])
     page = int(pagination['page'])
+    more = pagination.get('more', page < pages)
+    tokens = pagination.get('tokens', {})
 
-    if pages > 1:
-        if page == 1:
-            pass
-        else:
-            prev_url = rebuild_url(page=page - 1)
+    if page > 1:
+        prev_url = rebuild_url(page=page - 1, token=tokens.get('prev', None))
 
-        if page == pages:
-            pass
-        else:
-            next_url = rebuild_url(page=page + 1)
+    if more:
+        next_url = rebuild_url(page=page + 1, token=tokens.get('next', None))
 
     pagination['urls'] = {
         'prev': prev_url,
@@ -2006,17 +2453,20 @@ def build_pagination_urls(*, pagination):
     return pagination
 
 
-def rebuild_url(*, page):
+def rebuild_url(*, page, token=None):
     """
-    Rebuild a URL
+    Rebuild a URL, preferring a search_after cursor token over a page number
     """
     querystring = flask.request.query_string.decode()
     querystring = dict(urllib.parse.parse_qsl(querystring))
 
-    if querystring.get('page', False):
-        querystring.pop('page')
+    querystring.pop('page', None)
+    querystring.pop('token', None)
 
-    querystring['page'] = page
+    if token:
+        querystring['token'] = token
+    else:
+        querystring['page'] = page
 
     return f'{flask.request.path}?{urllib.parse.urlencode(querystring)}'
 
@@ -11037,6 +11037,14 @@ if (!org.woeplanet.map) {
             'side': 'side-map',
             'main': 'main-map'
         }
+        this.layers = {
+            'side': undefined,
+            'main': undefined
+        }
+        this.levels = {
+            'side': undefined,
+            'main': undefined
+        }
         this.popup = undefined;
         this.banner_height = 0;
         this.banner_width = 0;
@@ -11137,12 +11145,14 @@ if (!org.woeplanet.map) {
                 this.maps.main.fitBounds(org.woeplanet.bounds);
                 this.openPopup();
                 this.syncMaps();
+                this.watchGeometry();
             }
             else if (org.woeplanet.centroid) {
                 console.log('set main map to centroid');
                 this.maps.main.setView(org.woeplanet.centroid, org.woeplanet.zoom);
                 this.openPopup();
                 this.syncMaps();
+                this.watchGeometry();
             }
             else {
                 console.log('set main map to null island');
@@ -11175,6 +11185,60 @@ if (!org.woeplanet.map) {
         }
     }
 
+    // Pages only carry the bounds and centroid; the place's geometry is fetched once the main map is
+    // showing, simplified for the map's zoom. The side map, on every page, makes do with the bounds.
+    org.woeplanet.map.prototype.loadGeometry = function (name) {
+        var map = this.maps[name];
+        if (!map || !org.woeplanet.geometry_url) {
+            return;
+        }
+
+        var self = this;
+        var zoom = map.getZoom();
+        $.getJSON(org.woeplanet.geometry_url, { zoom: zoom }, function (data, _status, xhr) {
+            // Another request is building the place's geometry; try again once it's likely done
+            if (xhr.status === 202) {
+                var retry = parseInt(xhr.getResponseHeader('Retry-After'), 10) || 2;
+                setTimeout(function () {
+                    if (map.getZoom() === zoom) {
+                        self.loadGeometry(name);
+                    }
+                }, retry * 1000);
+                return;
+            }
+            if (!data || !data.properties || map.getZoom() !== zoom) {
+                return;
+            }
+            self.levels[name] = data.properties.zoom;
+            if (!data.geometry) {
+                return;
+            }
+            if (self.layers[name]) {
+                map.removeLayer(self.layers[name]);
+            }
+            self.layers[name] = L.geoJSON(data, {
+                style: {
+                    "color": "#ff7800",
+                    "weight": 2,
+                    "opacity": 0.65,
+                    "fillOpacity": 0.1
+                },
+                interactive: false
+            }).addTo(map);
+        });
+    };
+
+    // A coarser geometry is only worth replacing when zooming in past the detail it was simplified for
+    org.woeplanet.map.prototype.watchGeometry = function () {
+        this.loadGeometry('main');
+        this.maps.main.on('zoomend', function () {
+            var level = this.levels.main;
+            if (level === undefined || this.maps.main.getZoom() > level) {
+                this.loadGeometry('main');
+            }
+        }.bind(this));
+    };
+
     org.woeplanet.map.prototype.syncMaps = function () {
         if (!$.isEmptyObject(this.maps.main) && !$.isEmptyObject(this.maps.side)) {
             this.maps.main.on('zoomend', this.syncHandler.bind(this));